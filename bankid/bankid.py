@@ -1,23 +1,46 @@
 from bankid.stats import Timeline
-import requests
+import aiohttp
+import dataclasses
+import hashlib
+import re
 import time
 import asyncio
 
 from typing import Any
-from bs4 import BeautifulSoup
+from bankid import metrics
+from bankid.broadcast import Broadcast
 from bankid.classes import Status
+from bankid.parser import StatusParser
+from bankid.profiling import profiler, stage
+from bankid.scheduler import Scheduler
 from bankid.warden import Warden
 
+# Returned by from_bankid when the status page is the same as on the previous cycle.
+UNCHANGED = object()
+DIVS = re.compile(rb'<(/?)div\b[^>]*>', re.IGNORECASE)
+
 
 class BankID:
     def __init__(self, stats):
         self.stats = stats
         self.log = Warden()
         self.status = Status()
+        # Goes up every time the status or the statuspage document changes, waiters park on changed.
+        self.version = 0
+        self.changed = asyncio.Condition()
+        self.scheduler: Scheduler = None
+        self.broadcast = Broadcast()
+        # Called after every update cycle, once the next deadline is known.
+        self.observers: list = []
+        # Wall clock time of the next update, for workers that get their state from another worker.
+        self.deadline: float = None
         self.timeline = Timeline()
         self.openapi = {}
         self.api = {'Init': 'initializing'}
         self.url = 'https://www.bankid.no/status'
+        self.statuspage_url = 'https://bankid-services.statuspage.io/'
+        self.session: aiohttp.ClientSession = None
+        self.timeout = aiohttp.ClientTimeout(total=20, connect=5, sock_read=10)
         self.code: dict = {
             1: {
                 'meaning': 'Bankid har grønne lamper, alt er tut og kjør!',
@@ -56,46 +79,113 @@ class BankID:
                 'field': '11111111111111111111111111111111111',
             },
         }
+        # Maps the class of each status dot to its code, e.g. 'color-dot none' -> 1.
+        self.dots = {
+            code['field'].split('"')[1]: number for number, code in self.code.items() if code['field'].startswith('<span class="')
+        }
         self.refresh = 30
         self.lastupdate = int(time.time())
+        # Seconds each upstream gets per cycle, and the whole cycle gets, before its last good value is kept.
+        self.deadlines = {'bankid': 15, 'statuspage': 10, 'cycle': 20}
+        self.updated = {'bankid': None, 'statuspage': None}
+        # Sources whose last value was restored from the state file and has not been scraped again.
+        self.stale: set = set()
+        self.statuspage_error = {'Error': 'Couldnt retrieve data from statuspages.'}
+        self.validators = {'If-None-Match': None, 'If-Modified-Since': None}
+        self.digest = None
+        self.parses = {'full': 0, 'skipped': 0}
+        self.entry = None
 
     async def update(self) -> None:
+        '''Scrapes bankid.no and statuspage.io concurrently, a late source keeps its last good value.'''
+        async with profiler.cycle():
+            tasks = {
+                'bankid': asyncio.create_task(self.fetch('bankid', self.from_bankid())),
+                'statuspage': asyncio.create_task(self.fetch('statuspage', self.statuspages())),
+            }
+            done, _ = await asyncio.wait(tasks.values(), timeout=self.deadlines['cycle'])
 
-        bankid_data = await self.from_bankid()
-        status = await self.parsedata(bankid_data)
-        await self.updatestatus(status, bankid_data)
+            for source, task in tasks.items():
+                if task not in done:
+                    task.cancel()
+                    self.log.warn('Upstream missed the cycle deadline, keeping last good value', source=source)
+                elif task.exception() is None:
+                    await self.apply(source, task.result())
+                elif not isinstance(task.exception(), asyncio.TimeoutError):
+                    # Timeouts are logged by fetch(), anything else would otherwise only show as a stale source.
+                    await self.stats.errors()
+                    self.log.error('Upstream fetch failed, keeping last good value', source=source, exc_info=task.exception())
+
+    async def fetch(self, source: str, coro) -> Any:
+        '''Awaits an upstream fetch, giving up once the deadline for that source has passed.'''
+        began = time.perf_counter()
+        try:
+            with stage(source):
+                return await asyncio.wait_for(coro, self.deadlines[source])
+        except asyncio.TimeoutError:
+            self.log.warn('Upstream missed its deadline, keeping last good value', source=source)
+            raise
+        finally:
+            metrics.fetch.observe(time.perf_counter() - began, source)
 
-    async def parsedata(self, data: str) -> int:
+    async def apply(self, source: str, data: Any) -> None:
+        '''Applies a fresh result from one source.'''
+        if source == 'bankid' and data is UNCHANGED:
+            self.parses['skipped'] += 1
+            self.updated[source] = int(time.time())
+            self.stale.discard(source)
+            # Extends the open interval, which only touches the database now and then.
+            if self.entry is not None:
+                await self.timeline.put(*self.entry, now=self.updated[source])
+        elif source == 'bankid':
+            self.parses['full'] += 1
+            status, extra = await self.parsedata(data)
+            await self.updatestatus(status, extra)
+            if data is not None:
+                self.updated[source] = int(time.time())
+                self.stale.discard(source)
+        else:
+            changed = data != self.openapi
+            self.openapi = data
+            if changed:
+                await self.bump()
+            if data is not self.statuspage_error:
+                self.updated[source] = int(time.time())
+                self.stale.discard(source)
+
+    def staleness(self) -> dict:
+        '''When each source last produced a good value, as an epoch timestamp, and whether that value was restored
+        at startup and not scraped again yet.'''
+        return {source: {'updated': updated, 'stale': source in self.stale} for source, updated in self.updated.items()}
+
+    async def parsedata(self, data: bytes) -> tuple[int, Any]:
+        '''Reads the status code and the description text from the page in a single pass.'''
         if data is None:
-            return 9
-        soup = BeautifulSoup(data, 'html.parser')
-        for _data in soup.find_all("div", {"class": "m-statuspage"}):
-            _data = str(_data)
-            _data = _data.replace('\n', '')
-
-            for code in self.code:
-                if self.code[code]['field'] in _data:
-                    self.log.info('Status retrieved', code=code)
-                    return code
+            return 9, None
+        began = time.perf_counter()
+        with stage('parse'):
+            parser = StatusParser(self.dots).parse(data)
+        metrics.parse.observe(time.perf_counter() - began)
         # Return error code we couldnt find 'field' data.
-        return 9
+        code = parser.code if parser.code is not None else 9
+        if code != 9:
+            self.log.info('Status retrieved', code=code)
+        if code in [1, 9]:
+            return code, None
+        return code, parser.extra if parser.extra is not None else '\nKunne ikke innhente detaljert informasjon om bankidfeil.'
 
     async def updateloop(self) -> None:
-        '''Loop that runs update every 30 seconds.'''
-        timer = int(time.time())
-        while True:
-            if timer < int(time.time()):
-                await self.update()
-                timer += 60
-            await asyncio.sleep(1)
-
-    async def updatestatus(self, code: int, data: str) -> None:
+        '''Runs update on the adaptive schedule, every refresh seconds while nothing is happening.'''
+        self.scheduler = Scheduler(self)
+        await self.scheduler.run()
+
+    async def updatestatus(self, code: int, extra: Any) -> None:
         '''Updating the web view, api and db with status change.'''
-        extra = None if code in [1, 9] else await self.get_extra(data)
 
         # if code != self.status.statuscode and code not in [1, 9]:
         # await self.stats.changestatus(self.code[code]['color'], extra)
 
+        changed = (self.status.statuscode, self.status.extra) != (int(code), extra)
         self.status = Status(
             int(code),
             self.code[code]['meaning'],
@@ -106,7 +196,8 @@ class BankID:
 
         # Updates the timeline
         status_text = extra if extra is not None else self.code[code]['text']
-        self.timeline.put(status_text, self.code[code]['color'])
+        self.entry = (status_text, self.code[code]['color'])
+        await self.timeline.put(*self.entry)
 
         self.api = {
             'bidi': {
@@ -117,41 +208,147 @@ class BankID:
                 'meaning': self.code[code]['meaning'],
             }
         }
+        if changed:
+            await self.bump()
+            self.broadcast.publish(self.broadcast.event('status', self.api, self.version))
+
+    async def client(self) -> aiohttp.ClientSession:
+        '''Returns the shared upstream session, creating it on first use.'''
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=10, ttl_dns_cache=300, keepalive_timeout=120)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
 
-        self.openapi = await self.statuspages()
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
 
     async def statuspages(self):
-        url = 'https://bankid-services.statuspage.io/'
         header = {'Accept': 'application/json'}
-        response = {'Error': 'Couldnt retrieve data from statuspages.'}
+        response = self.statuspage_error
         try:
-            r = requests.get(url, headers=header)
-            if r.status_code == 200:
-                return r.json()
+            session = await self.client()
+            async with session.get(self.statuspage_url, headers=header) as r:
+                if r.status == 200:
+                    return await r.json(content_type=None)
         except Exception:  # noqa: W0703
-            self.stats.errors()
+            await self.stats.errors()
             self.log.exception('Exception occured while retrieving data from bankid-services.statuspage.io')
-            return response
+        return response
 
-    async def get_extra(self, data: str) -> Any:
-        ret = None
-        soup = BeautifulSoup(data, 'html.parser')
-        _data = soup.find_all("div", {"class": "m-statuspage-description"})
-        for x in _data:
-            ret = x.find_next("p").get_text().replace('\n', '').replace('\r', '').strip()
-        return ret if ret is not None else '\nKunne ikke innhente detaljert informasjon om bankidfeil.'
+    def section(self, data: bytes) -> bytes:
+        '''Cuts out every byte StatusParser reads the status from: from the first m-statuspage tag to
+        the close tag of the outermost div around the last one. When a description comes last, its
+        paragraph may follow that div, so the section then runs on to the end of that paragraph.'''
+        first = data.find(b'm-statuspage')
+        if first == -1:
+            return data
+        start = max(data.rfind(b'<', 0, first), 0)
+        last = data.rfind(b'm-statuspage')
+        depth, end = 0, None
+        for tag in DIVS.finditer(data, start):
+            depth += -1 if tag.group(1) else 1
+            if depth <= 0:
+                depth = 0
+                if tag.start() > last:
+                    end = tag.end()
+                    break
+        if end is None:
+            return data[start:]
+        described = data.rfind(b'm-statuspage-description', start, end)
+        if described != -1 and data.find(b'<p', described, end) == -1:
+            paragraph = data.find(b'</p>', end)
+            end = paragraph + 4 if paragraph != -1 else len(data)
+        return data[start:end]
 
     async def from_bankid(self) -> str:
+        '''Fetches the status page. Returns UNCHANGED when neither the page nor its status section has changed.'''
+        headers = {header: value for header, value in self.validators.items() if value is not None}
         try:
-            r = requests.get(self.url, allow_redirects=True)
-            if r:
-                return r.content
-            else:
-                return None
-        except requests.exceptions.RequestException:
+            session = await self.client()
+            async with session.get(self.url, allow_redirects=True, headers=headers) as r:
+                if r.status == 304:
+                    return UNCHANGED
+                if not r.ok:
+                    self.forget()
+                    return None
+                self.validators['If-None-Match'] = r.headers.get('ETag')
+                self.validators['If-Modified-Since'] = r.headers.get('Last-Modified')
+                data = await r.read()
+                digest = hashlib.blake2b(self.section(data), digest_size=16).digest()
+                if digest == self.digest:
+                    return UNCHANGED
+                self.digest = digest
+                return data
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.forget()
             self.log.exception('Unable to retrieve data from bankid.no')
             await self.stats.errors()
             return None
 
+    def forget(self) -> None:
+        '''Drops the validators and digest, a failed fetch replaced the status so the next page must be parsed.'''
+        self.validators = {'If-None-Match': None, 'If-Modified-Since': None}
+        self.digest = None
+
     def get_status(self) -> Status:
         return self.status
+
+    async def bump(self) -> None:
+        '''Moves the status version forward and wakes everyone waiting for it.'''
+        async with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    async def wait(self, since: int, timeout: float) -> int:
+        '''Waits up to timeout seconds for the status version to pass since. Returns the version.'''
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(lambda: self.version > since), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.version
+
+    def next_update(self) -> int:
+        '''Seconds until the scheduler runs the next update, 0 when it is due or not running.'''
+        if self.scheduler is None or self.scheduler.deadline is None:
+            return 0 if self.deadline is None else max(0, int(self.deadline - time.time()))
+        return max(0, int(self.scheduler.deadline - self.scheduler.clock()))
+
+    def notify(self) -> None:
+        '''Tells the observers that an update cycle is done.'''
+        for observer in self.observers:
+            observer()
+
+    def snapshot(self) -> dict:
+        '''Everything the web views need, as plain data.'''
+        return {
+            'version': self.version,
+            'status': dataclasses.astuple(self.status),
+            'api': self.api,
+            'openapi': self.openapi,
+            'updated': self.updated,
+            'parses': self.parses,
+            'stale': sorted(self.stale),
+            'deadline': time.time() + self.next_update(),
+            'timeline': self.timeline.snapshot(),
+        }
+
+    async def restore(self, snapshot: dict) -> None:
+        '''Takes over the state from a snapshot, waking waiters and streams when the status changed.'''
+        changed = tuple(snapshot['status']) != dataclasses.astuple(self.status)
+        self.status = Status(*snapshot['status'])
+        self.api = snapshot['api']
+        self.openapi = snapshot['openapi']
+        self.updated = snapshot['updated']
+        self.parses = snapshot['parses']
+        self.stale = set(snapshot.get('stale', ()))
+        self.deadline = snapshot['deadline']
+        if 'timeline' in snapshot:
+            self.timeline.restore(snapshot['timeline'])
+        if snapshot['version'] != self.version:
+            async with self.changed:
+                self.version = snapshot['version']
+                self.changed.notify_all()
+        if changed:
+            self.broadcast.publish(self.broadcast.event('status', self.api, self.version))
@@ -0,0 +1,64 @@
+import asyncio
+from contextlib import contextmanager
+from typing import Iterator
+
+import orjson
+
+from bankid.warden import Warden
+
+log = Warden()
+
+
+class Broadcast:
+    '''Fans Server-Sent Events out to every connected stream.
+
+    An event is encoded once and handed to each subscriber with put_nowait, so publishing never
+    waits on a client. Every subscriber has a small bounded queue; a reader that falls that far
+    behind is dropped, the stream ends and the client reconnects to get the current state.
+    '''
+
+    heartbeat = 15
+    backlog = 16
+
+    def __init__(self):
+        self.subscribers: set[asyncio.Queue] = set()
+        self.published = 0
+        self.dropped = 0
+
+    @staticmethod
+    def event(name: str, data: dict, _id: int = None) -> bytes:
+        '''Encodes one event in the text/event-stream format.'''
+        head = f'id: {_id}\n' if _id is not None else ''
+        return f'{head}event: {name}\n'.encode() + b'data: ' + orjson.dumps(data) + b'\n\n'
+
+    @contextmanager
+    def subscribe(self) -> Iterator[asyncio.Queue]:
+        '''A queue that receives every event published while the block is open, None means the stream is over.'''
+        queue = asyncio.Queue(self.backlog)
+        self.subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self.subscribers.discard(queue)
+
+    def publish(self, event: bytes) -> None:
+        '''Hands an encoded event to every subscriber without waiting on any of them.'''
+        self.published += 1
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Make room for the end marker and forget the subscriber.
+                self.subscribers.discard(queue)
+                self.dropped += 1
+                queue.get_nowait()
+                queue.put_nowait(None)
+                log.debug('Dropped a stream that could not keep up')
+
+    async def close(self, app=None) -> None:  # noqa: W0613
+        '''Ends every open stream, used when the server shuts down.'''
+        for queue in list(self.subscribers):
+            self.subscribers.discard(queue)
+            while queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
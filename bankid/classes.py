@@ -26,10 +26,11 @@ class Auth:
     is_auth: bool = False
     user: dict = None
 
-    def __init__(self, key, db):
-        self.x = Users(db)
-        if self.x.check(key):
-            log.info('Access granted to api', user=self.x.user[2])
+    def __init__(self, users: Users):
+        '''Takes a Users that has already run check() for the callers key.'''
+        self.x = users
+        if self.x.user is not None:
+            log.count('Access granted to api', user=self.x.user[2])
             self.is_auth = True
             self.user = self.x.user
 
@@ -51,6 +52,8 @@ class Api:
     message: str = None
     bidi: str = None
     openapi: str = None
+    sources: dict = None
+    version: int = None
 
 
 @dataclass
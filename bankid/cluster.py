@@ -0,0 +1,212 @@
+'''Multi-worker serving. Every worker listens on the same port with SO_REUSEPORT, one of them scrapes.'''
+
+import asyncio
+import fcntl
+import os
+import signal
+import struct
+import time
+
+import orjson
+
+from bankid.warden import Warden
+
+log = Warden()
+
+
+class Lease:
+    '''An exclusive flock on a file. The kernel drops it when the holder dies, however it dies.'''
+
+    def __init__(self, path: str = 'scraper.lock'):
+        self.path = path
+        self.fd = None
+
+    def acquire(self) -> bool:
+        '''Takes the lease if nobody holds it, without waiting.'''
+        if self.fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # The holder's pid, for people and tools looking at the file.
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self.fd = fd
+        return True
+
+    def holder(self) -> int:
+        '''The pid of the worker holding the lease, or 0 if it is unknown.'''
+        try:
+            with open(self.path, encoding='UTF-8') as lease:
+                return int(lease.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+
+class Cluster:
+    '''Coordinates one worker of a multi-worker server.
+
+    The worker holding the lease runs the update loop and retention, listens on a Unix socket and
+    pushes a snapshot of its state to every connected worker after each update cycle. The others
+    connect to that socket and apply the snapshots, so after startup they neither scrape nor read
+    status.db. When the scraper dies its socket closes, and the workers race for the lease right away.
+    '''
+
+    # Unsent bytes a follower may have queued before it is disconnected.
+    backlog = 1 << 20
+
+    def __init__(self, server, lease: str = 'scraper.lock', socket: str = 'bidi.sock'):
+        self.server = server
+        self.bidi = server.bidi
+        self.lease = Lease(lease)
+        self.socket = socket
+        self.followers: set[asyncio.StreamWriter] = set()
+        self.snapshot: bytes = None
+        self.leading = False
+
+    @staticmethod
+    def frame(data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + data
+
+    async def run(self) -> None:
+        '''Leads when the lease can be taken, follows the leader otherwise.'''
+        while True:
+            try:
+                if self.lease.acquire():
+                    await self.lead()
+                await self.follow()
+            except Exception:  # noqa: W0703
+                log.exception('Worker coordination failed, trying again')
+                await asyncio.sleep(1)
+
+    async def lead(self) -> None:
+        log.info('Took the scraper lease', pid=os.getpid())
+        # The intervals may have moved on while another worker was scraping.
+        await asyncio.get_running_loop().run_in_executor(None, self.bidi.timeline.load)
+        # run() calls this again after a failure, and the lease is still ours then.
+        if not self.leading:
+            self.bidi.observers.append(self.publish)
+            self.leading = True
+        self.publish()
+        if os.path.exists(self.socket):
+            os.unlink(self.socket)
+        server = await asyncio.start_unix_server(self.welcome, path=self.socket)
+        loops = [asyncio.ensure_future(self.bidi.updateloop()), asyncio.ensure_future(self.server.retention.loop())]
+        try:
+            await asyncio.gather(*loops)
+        finally:
+            # gather leaves the other loop running when one fails, and run() is about to start both again.
+            for task in loops:
+                task.cancel()
+            await asyncio.gather(*loops, return_exceptions=True)
+            server.close()
+
+    async def welcome(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Sends the current snapshot to a new follower and keeps it until it goes away.'''
+        self.followers.add(writer)
+        writer.write(self.snapshot)
+        try:
+            await reader.read()
+        except ConnectionError:
+            # The follower was killed, which is the same as it going away.
+            pass
+        finally:
+            self.followers.discard(writer)
+            writer.close()
+
+    def publish(self) -> None:
+        '''Encodes the state once and queues it for every follower, dropping any that stopped reading.'''
+        self.snapshot = self.frame(orjson.dumps(self.bidi.snapshot()))
+        for writer in list(self.followers):
+            if writer.transport.get_write_buffer_size() > self.backlog:
+                log.warn('Dropped a worker that stopped reading snapshots')
+                self.followers.discard(writer)
+                writer.close()
+                continue
+            writer.write(self.snapshot)
+
+    async def follow(self) -> None:
+        '''Applies snapshots from the leader until its socket closes.'''
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # The new leader is still starting up.
+            await asyncio.sleep(0.2)
+            return
+        try:
+            while True:
+                size = struct.unpack('>I', await reader.readexactly(4))[0]
+                await self.bidi.restore(orjson.loads(await reader.readexactly(size)))
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            log.info('Lost the scraper, trying to take over')
+        finally:
+            writer.close()
+
+
+def worker() -> None:
+    '''Entry point of a worker process.'''
+    from bankid.webserver import Webserver
+
+    asyncio.run(Webserver().run(cluster=True))
+
+
+def serve(workers: int, target=worker, quick: float = 10, backoff: float = 1, max_backoff: float = 60, failures: int = 5) -> None:
+    '''Starts workers processes and starts them again when they die, until it is told to stop.
+
+    A worker that dies within quick seconds of starting is started again after a delay that doubles
+    with every such failure in a row, up to max_backoff. After failures of those in a row the
+    supervisor gives up and exits, since the worker cannot start, e.g. because the port is taken.
+    '''
+    # Only the supervisor needs multiprocessing, the workers import this module too.
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+    started = {}
+    # Quick failures in a row per worker, and when the dead ones are due to be started again.
+    failed = dict.fromkeys(range(workers), 0)
+    due = {}
+
+    def start(n):
+        processes[n] = context.Process(target=target, name=f'bidi-worker-{n}', daemon=True)
+        processes[n].start()
+        started[n] = time.monotonic()
+
+    def stop(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    for n in range(workers):
+        start(n)
+    log.info(f'Started {workers} workers')
+    try:
+        while True:
+            timeout = max(0, min(due.values()) - time.monotonic()) if due else None
+            wait([process.sentinel for process in processes.values()], timeout)
+            now = time.monotonic()
+            for n, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                del processes[n]
+                failed[n] = failed[n] + 1 if now - started[n] < quick else 0
+                if failed[n] >= failures:
+                    log.error('Worker keeps dying at startup, giving up', worker=n, exitcode=process.exitcode, failures=failed[n])
+                    raise SystemExit(1)
+                delay = min(backoff * 2 ** (failed[n] - 1), max_backoff) if failed[n] else 0
+                log.warn('Worker died, starting it again', worker=n, exitcode=process.exitcode, delay=delay)
+                due[n] = now + delay
+            for n, when in list(due.items()):
+                if when <= now:
+                    del due[n]
+                    start(n)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
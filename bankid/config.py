@@ -14,6 +14,11 @@ class Config:
                 top.host = data['webserver']['host']
                 top.port = data['webserver']['port']
                 top.bidi.refresh = data['refresh_time']
+                top.workers = data.get('workers', 1)
+                for setting, value in data.get('retention', {}).items():
+                    if not hasattr(top.retention, setting):
+                        raise AttributeError(f'Unknown retention setting {setting}')
+                    setattr(top.retention, setting, value)
         except JSONDecodeError:
             log.exception('Couldnt decode json data')
         except FileNotFoundError:
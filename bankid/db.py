@@ -1,10 +1,95 @@
+import asyncio
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from bankid.profiling import stage
+from bankid.users import KeyCache
+
+
+class Pool:
+    '''Asyncio access to a sqlite database without blocking the event loop.
+
+    Reads run on a small pool of threads that each hold their own connection. Every write runs on
+    a single writer thread with its own connection, so writes are serialized and never wait on a
+    lock held by another writer in this process. The database runs in WAL mode so reads and the
+    writer do not block each other.
+    '''
+
+    pragmas = (
+        'PRAGMA busy_timeout=5000;',
+        'PRAGMA journal_mode=WAL;',
+        'PRAGMA synchronous=NORMAL;',
+        'PRAGMA mmap_size=268435456;',
+        'PRAGMA cache_size=-16000;',
+        'PRAGMA temp_store=MEMORY;',
+    )
+
+    def __init__(self, path: str, readers: int = 2):
+        self.path = path
+        self.local = threading.local()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='sqlite-reader')
+
+    def connection(self) -> sqlite3.Connection:
+        '''The connection belonging to the calling thread.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            for pragma in self.pragmas:
+                conn.execute(pragma)
+            self.local.conn = conn
+        return conn
+
+    def _read(self, sql: str, params: Any) -> list:
+        return self.connection().execute(sql, params).fetchall()
+
+    def _transaction(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = self.connection()
+        with conn:
+            return func(conn)
+
+    def _write(self, sql: str, params: Any, many: bool) -> int:
+        if many:
+            return self._transaction(lambda conn: conn.executemany(sql, params).rowcount)
+        return self._transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def read(self, sql: str, params: Any = ()) -> list:
+        with stage('sqlite'):
+            return await asyncio.get_running_loop().run_in_executor(self.readers, self._read, sql, params)
+
+    async def write(self, sql: str, params: Any = (), many: bool = False) -> int:
+        '''Runs one statement on the writer thread and commits it. Returns the rowcount.'''
+        with stage('sqlite'):
+            return await asyncio.get_running_loop().run_in_executor(self.writer, self._write, sql, params, many)
+
+    async def transaction(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        '''Calls func with the writer connection inside a single transaction.'''
+        with stage('sqlite'):
+            return await asyncio.get_running_loop().run_in_executor(self.writer, self._transaction, func)
+
+    def read_blocking(self, sql: str, params: Any = ()) -> list:
+        '''read() for startup code and scripts that run outside the event loop.'''
+        return self.readers.submit(self._read, sql, params).result()
+
+    def write_blocking(self, sql: str, params: Any = (), many: bool = False) -> int:
+        '''write() for startup code and scripts that run outside the event loop.'''
+        return self.writer.submit(self._write, sql, params, many).result()
+
+    def transaction_blocking(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        '''transaction() for startup code and scripts that run outside the event loop.'''
+        return self.writer.submit(self._transaction, func).result()
+
+    def close(self) -> None:
+        self.writer.shutdown()
+        self.readers.shutdown()
 
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('users.db')
-        self.cursor = self.conn.cursor()
+    def __init__(self, path: str = 'users.db'):
+        self.pool = Pool(path)
+        self.keys = KeyCache()
         user = """
             CREATE TABLE IF NOT EXISTS users (key CHAR, user CHAR, email CHAR, phone CHAR, method CHAR, expire BIGINT)
         """
@@ -17,12 +102,21 @@ class Database:
         slack = """
             CREATE TABLE IF NOT EXISTS slack (user CHAR, webhook JSON, active INT);
         """
+        # Moved by triggers on every change to users, so the key caches of all workers can tell a
+        # change to the keys apart from the stats flushes that land in the same file.
+        users_version = """
+            CREATE TABLE IF NOT EXISTS users_version (version INTEGER NOT NULL);
+        """
 
-        self.cursor.execute(user)
-        self.cursor.execute(stats)
-        self.cursor.execute(status)
-        self.cursor.execute(slack)
-        self.conn.commit()
-
-    def __del__(self):
-        self.conn.commit()
+        self.pool.write_blocking(user)
+        self.pool.write_blocking('CREATE INDEX IF NOT EXISTS users_key ON users (key);')
+        self.pool.write_blocking(stats)
+        self.pool.write_blocking(status)
+        self.pool.write_blocking(slack)
+        self.pool.write_blocking(users_version)
+        self.pool.write_blocking('INSERT INTO users_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM users_version);')
+        for change in ('INSERT', 'UPDATE', 'DELETE'):
+            self.pool.write_blocking(
+                f'CREATE TRIGGER IF NOT EXISTS users_{change.lower()} AFTER {change} ON users'
+                ' BEGIN UPDATE users_version SET version = version + 1; END;'
+            )
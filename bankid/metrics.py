@@ -0,0 +1,129 @@
+'''Prometheus text format metrics.
+
+Metrics register themselves in a module level registry. Observing a value is a bisect and a few
+in-place increments on lists that exist from the first observation on, so it is cheap enough
+for the request path. Everything else happens when /metrics is rendered.
+'''
+
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable
+
+# name -> metric, so a metric created again (a new Webserver in the same process) replaces the old one.
+registry: dict = {}
+
+# Seconds, from a fast in-memory lookup up to a slow upstream.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def labelset(names: tuple, values) -> str:
+    if not names:
+        return ''
+    values = values if isinstance(values, tuple) else (values,)
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    '''Observations counted into fixed buckets, per label value. With one label the value is the key.'''
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.description = description
+        self.names = labels
+        self.buckets = buckets
+        # label value(s) -> [count per bucket plus one for +Inf, sum]
+        self.children: dict = {}
+        registry[name] = self
+
+    def observe(self, value: float, key=None) -> None:
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        child[0][bisect_left(self.buckets, value)] += 1
+        child[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(self.children.items(), key=lambda item: str(item[0])):
+            labels = labelset(self.names, key)
+            inner = labels[1:-1] + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{inner}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{labels} {number(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Counter:
+    '''A count per label value. With one label the value is the key.'''
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.names = labels
+        self.values: dict = {}
+        registry[name] = self
+
+    def inc(self, key=None, amount: int = 1) -> None:
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            lines.append(f'{self.name}{labelset(self.names, key)} {number(value)}')
+        return lines
+
+
+class Gauge:
+    '''A value read from func when the metrics are rendered. func may return a dict of label value to value.'''
+
+    def __init__(self, name: str, description: str, func: Callable, labels: tuple = (), kind: str = 'gauge'):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.names = labels
+        self.kind = kind
+        registry[name] = self
+
+    def render(self) -> list[str]:
+        value = self.func()
+        if value is None:
+            return []
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for key, item in (value.items() if isinstance(value, dict) else [(None, value)]):
+            lines.append(f'{self.name}{labelset(self.names, key)} {number(item)}')
+        return lines
+
+
+def render() -> bytes:
+    '''Every registered metric in the Prometheus text format.'''
+    lines = []
+    for metric in registry.values():
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode()
+
+
+fetch = Histogram('bidi_fetch_seconds', 'Time to fetch each upstream, including failed attempts.', ('source',))
+parse = Histogram('bidi_parse_seconds', 'Time spent in BankID.parsedata reading the status page.')
+timeline_put = Histogram('bidi_timeline_put_seconds', 'Time spent in Timeline.put, including the write.')
+timeline_query = Histogram('bidi_timeline_query_seconds', 'Time to produce the 168 hours of Timeline.query.')
+auth = Histogram('bidi_auth_seconds', 'Time to look up an api key.')
+requests = Histogram('bidi_request_seconds', 'Time to answer a request, per route.', ('route',))
+responses = Counter('bidi_responses_total', 'Responses sent, per route and status code.', ('route', 'code'))
+loop_lag = Histogram('bidi_loop_lag_seconds', 'How late the event loop woke up a sleeping task.')
+
+
+async def monitor(interval: float = 0.5) -> None:
+    '''Measures event loop lag by how late a fixed sleep wakes up.'''
+    while True:
+        began = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - began - interval))
@@ -0,0 +1,73 @@
+from html.parser import HTMLParser
+from typing import Optional
+
+
+class StatusParser(HTMLParser):
+    '''Single pass over the bankid.no status page without building a tree.
+
+    Collects the status dots found inside every div.m-statuspage, and the text of the first
+    paragraph following each div.m-statuspage-description. Like the BeautifulSoup lookups it
+    replaces, the first div.m-statuspage holding a known dot decides the code (lowest code wins
+    within that div), and the last description found is the one that is kept.
+    '''
+
+    def __init__(self, dots: dict):
+        super().__init__(convert_charrefs=True)
+        self.dots = dots
+        self.divs: list[Optional[set]] = []
+        self.found: list[set] = []
+        self.pending = False
+        self.capture: Optional[list] = None
+        self.extra: Optional[str] = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'div':
+            classes = (dict(attrs).get('class') or '').split()
+            if 'm-statuspage' in classes:
+                codes = set()
+                self.found.append(codes)
+                self.divs.append(codes)
+            else:
+                self.divs.append(None)
+            if 'm-statuspage-description' in classes:
+                self.pending = True
+        elif tag == 'span' and len(attrs) == 1 and attrs[0][0] == 'class':
+            code = self.dots.get(' '.join((attrs[0][1] or '').split()))
+            if code is not None:
+                for codes in self.divs:
+                    if codes is not None:
+                        codes.add(code)
+        elif tag == 'p' and self.pending:
+            self.pending = False
+            self.capture = []
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self.divs:
+            self.divs.pop()
+        elif tag == 'p' and self.capture is not None:
+            self.extra = ''.join(self.capture).replace('\n', '').replace('\r', '').strip()
+            self.capture = None
+
+    def handle_data(self, data):
+        if self.capture is not None:
+            self.capture.append(data)
+
+    @property
+    def code(self) -> Optional[int]:
+        for codes in self.found:
+            if codes:
+                return min(codes)
+        return None
+
+    def parse(self, data: bytes) -> 'StatusParser':
+        '''Feeds the page from the first m-statuspage tag onwards, the head and navigation are never tokenized.'''
+        if isinstance(data, str):
+            data = data.encode()
+        first = data.find(b'm-statuspage')
+        if first != -1:
+            data = data[max(data.rfind(b'<', 0, first), 0):]
+        self.feed(data.decode('utf-8', errors='replace'))
+        self.close()
+        if self.capture is not None:
+            self.handle_endtag('p')
+        return self
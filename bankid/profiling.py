@@ -0,0 +1,139 @@
+'''Opt-in profiling of requests and update cycles.
+
+Off unless PROFILE=1 is set, or an admin adds ?profile=1 to a request. In profiling mode every
+request gets a stage-by-stage timing breakdown, and the ones slower than PROFILE_SLOW_MS are
+logged with it. A PROFILE_SAMPLE share of the requests and every update cycle also run under
+cProfile, and the profiles are added up for /{key}/admin/profile.
+
+cProfile sees everything the event loop runs while it is enabled, so a profiled request also
+shows the requests and the scrape that ran at the same time. Only one profile runs at a time.
+'''
+
+import contextlib
+import contextvars
+import io
+import marshal
+import os
+import time
+import typing
+
+from bankid.warden import Warden
+
+if typing.TYPE_CHECKING:
+    # Imported when the first profile starts, pstats alone costs about 10 ms at startup.
+    import cProfile
+    import pstats
+
+log = Warden()
+
+# Stage timings of the request or update cycle being measured, None when nothing is.
+current: contextvars.ContextVar = contextvars.ContextVar('stages', default=None)
+nothing = contextlib.nullcontext()
+
+
+class Stage:
+    '''Adds the time spent in the block to the breakdown being measured.'''
+
+    __slots__ = ('name', 'stages', 'began')
+
+    def __init__(self, name: str, stages: dict):
+        self.name = name
+        self.stages = stages
+
+    def __enter__(self):
+        self.began = time.perf_counter()
+
+    def __exit__(self, *_):
+        self.stages[self.name] = self.stages.get(self.name, 0.0) + time.perf_counter() - self.began
+
+
+def stage(name: str):
+    '''Times a block as part of the current breakdown, and costs a context variable lookup when there is none.'''
+    stages = current.get()
+    return nothing if stages is None else Stage(name, stages)
+
+
+def breakdown(stages: dict) -> dict:
+    return {name: round(seconds * 1000, 2) for name, seconds in stages.items()}
+
+
+class Profiler:
+    '''Settings from the environment, the profile that is running and the profiles added up so far.'''
+
+    def __init__(self):
+        self.enabled = os.getenv('PROFILE', '0') == '1'
+        self.sample = float(os.getenv('PROFILE_SAMPLE', '0.01'))
+        self.slow = float(os.getenv('PROFILE_SLOW_MS', '250')) / 1000
+        self.running: 'cProfile.Profile' = None
+        self.stats: 'pstats.Stats' = None
+        self.profiled = {'requests': 0, 'updates': 0, 'skipped': 0}
+        # Update cycles started, and whether one is running, so a request can tell it overlapped one.
+        self.cycles = 0
+        self.updating = False
+
+    def start(self) -> 'cProfile.Profile':
+        '''Starts a profile, or returns None if one is already running.'''
+        if self.running is not None:
+            self.profiled['skipped'] += 1
+            return None
+        import cProfile
+
+        self.running = cProfile.Profile()
+        self.running.enable()
+        return self.running
+
+    def stop(self, profile: 'cProfile.Profile', kind: str) -> None:
+        import pstats
+
+        profile.disable()
+        self.running = None
+        self.profiled[kind] += 1
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def dump(self) -> bytes:
+        '''The profiles added up, in the format of pstats.dump_stats.'''
+        return marshal.dumps(self.stats.stats if self.stats is not None else {})
+
+    def text(self, limit: int = 50) -> str:
+        '''The functions with the most cumulative time, as pstats prints them.'''
+        if self.stats is None:
+            return 'No profiles yet.\n'
+        out = io.StringIO()
+        self.stats.stream = out
+        self.stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def reset(self) -> None:
+        self.stats = None
+        self.profiled = {'requests': 0, 'updates': 0, 'skipped': 0}
+
+    @contextlib.asynccontextmanager
+    async def cycle(self):
+        '''Wraps an update cycle, profiling it and logging its breakdown in profiling mode.'''
+        self.cycles += 1
+        self.updating = True
+        if not self.enabled:
+            try:
+                yield
+            finally:
+                self.updating = False
+            return
+        stages = {}
+        token = current.set(stages)
+        profile = self.start()
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - began
+            self.updating = False
+            current.reset(token)
+            if profile is not None:
+                self.stop(profile, 'updates')
+            log.info('Update cycle', total_ms=round(elapsed * 1000, 2), stages=breakdown(stages))
+
+
+profiler = Profiler()
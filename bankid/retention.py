@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import deque
+
+from bankid.stats import Timeline
+from bankid.warden import Warden
+
+log = Warden()
+
+
+class Retention:
+    '''Background pruning of status.db.
+
+    Intervals that ended more than raw_days ago are deleted, the hourly rollup already holds them.
+    Hourly rows older than hourly_days are folded into one row per day, the worst color of that day,
+    and deleted. Daily rows are kept. Every batch of at most batch rows is its own short transaction on the writer
+    thread, and the freed pages are handed back to the filesystem with incremental vacuum.
+    '''
+
+    raw_days = 14
+    hourly_days = 90
+    batch = 500
+    vacuum_pages = 256
+    interval = 3600
+
+    def __init__(self, timeline: Timeline):
+        self.timeline = timeline
+        self.pool = timeline.pool
+        self.pruned = {'raw': 0, 'hourly': 0}
+        # (time, bytes in use, bytes free) after every run, a month of them at the default interval.
+        self.sizes = deque(maxlen=720)
+        self.pool.write_blocking(
+            'CREATE TABLE IF NOT EXISTS daily (day INTEGER PRIMARY KEY, time INTEGER, status CHAR, color CHAR, rank INTEGER);'
+        )
+        if self.pool.read_blocking('PRAGMA auto_vacuum;')[0][0] != 2:
+            # Only takes effect after a full VACUUM, which is done once here.
+            log.info('Switching status.db to incremental vacuum')
+            self.pool.write_blocking('PRAGMA auto_vacuum=INCREMENTAL;')
+            self.pool.write_blocking('VACUUM;')
+
+    def fold(self, source: str, target: str, key: str, select: str, condition: str = '') -> str:
+        '''An upsert of rows from source into target where only a strictly worse color replaces what is there.'''
+        return f"""
+            INSERT INTO {target} ({key}, time, status, color, rank)
+            SELECT {select} FROM {source} WHERE {{where}}{condition} ORDER BY time
+            ON CONFLICT({key}) DO UPDATE SET
+                time = excluded.time, status = excluded.status, color = excluded.color, rank = excluded.rank
+            WHERE excluded.rank < {target}.rank;
+        """
+
+    async def prune(self, table: str, key: str, where: str, cutoff: int, fold: str = None) -> int:
+        '''Folds and deletes the rows matching where, one batch per transaction. Returns the number deleted.'''
+
+        def batch(conn):
+            keys = [row[0] for row in conn.execute(f'SELECT {key} FROM {table} WHERE {where} LIMIT ?;', (cutoff, self.batch))]
+            if keys:
+                marks = ', '.join('?' * len(keys))
+                if fold is not None:
+                    conn.execute(fold.format(where=f'{key} IN ({marks})'), keys)
+                conn.execute(f'DELETE FROM {table} WHERE {key} IN ({marks});', keys)
+            return len(keys)
+
+        deleted = 0
+        while True:
+            count = await self.pool.transaction(batch)
+            deleted += count
+            if count < self.batch:
+                return deleted
+            # Let the scraper and the request handlers get to the writer between batches.
+            await asyncio.sleep(0)
+
+    async def vacuum(self) -> None:
+        '''Returns free pages to the filesystem a few at a time, until none are left or none could be freed.'''
+        free = (await self.pool.read('PRAGMA freelist_count;'))[0][0]
+        while free:
+            # execute() only steps the pragma once, which frees a single page. executescript() runs it to the end.
+            await self.pool.transaction(lambda conn: conn.executescript(f'PRAGMA incremental_vacuum({self.vacuum_pages});'))
+            left = (await self.pool.read('PRAGMA freelist_count;'))[0][0]
+            if left >= free:
+                return
+            free = left
+
+    async def size(self) -> tuple[int, int]:
+        '''Bytes in use and bytes free in the database file.'''
+        page_size = (await self.pool.read('PRAGMA page_size;'))[0][0]
+        pages = (await self.pool.read('PRAGMA page_count;'))[0][0]
+        free = (await self.pool.read('PRAGMA freelist_count;'))[0][0]
+        return (pages - free) * page_size, free * page_size
+
+    async def run(self, now: int = None) -> dict:
+        '''Applies the policy once. Returns how many rows were pruned from each table.'''
+        now = int(time.time()) if now is None else now
+        began = time.monotonic()
+        # Cut on whole hours and days, so the rows a bucket is folded from all go in the same run.
+        raw_cutoff = now - now % 3600 - self.raw_days * 86400
+        # The ring buffer is loaded from the last week of the hourly rollup, that week always stays.
+        hourly_cutoff = now - now % 86400 - max(self.hourly_days, 7) * 86400
+
+        hourly = self.fold('hourly', 'daily', 'day', 'hour - hour % 86400, time, status, color, rank')
+
+        pruned = {
+            # The latest interval may still be extended, it always stays.
+            'raw': await self.prune('intervals', 'id', 'until < ? AND id < (SELECT MAX(id) FROM intervals)', raw_cutoff),
+            'hourly': await self.prune('hourly', 'hour', 'hour < ?', hourly_cutoff, hourly),
+        }
+        for table, count in pruned.items():
+            self.pruned[table] += count
+        if any(pruned.values()):
+            await self.vacuum()
+
+        used, free = await self.size()
+        self.sizes.append((now, used, free))
+        log.info('Applied retention', pruned=pruned, bytes=used, seconds=round(time.monotonic() - began, 2))
+        return pruned
+
+    async def loop(self) -> None:
+        '''Applies the policy every interval seconds.'''
+        while True:
+            try:
+                await self.run()
+            except Exception:  # noqa: W0703
+                log.exception('Retention run failed')
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,77 @@
+import asyncio
+import random
+import time
+
+from bankid.warden import Warden
+
+log = Warden()
+
+
+class Scheduler:
+    '''Runs BankID.update on an adaptive schedule.
+
+    The base interval is BankID.refresh, read every cycle so a reloaded configuration takes effect.
+    While the status is degraded (yellow, orange or red) the interval is shortened, and once it has
+    been green for calm_after seconds it is stretched. Every interval gets a little jitter. Updates
+    never overlap: a cycle that overruns its slot is followed by the next one after min_interval.
+
+    clock, sleep and rng are injectable so the schedule can be driven by a fake clock.
+    '''
+
+    degraded = (2, 3, 4)
+
+    def __init__(self, bidi, clock=time.monotonic, sleep=asyncio.sleep, rng=random.random):
+        self.bidi = bidi
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng
+        self.degraded_factor = 0.25
+        self.calm_factor = 2
+        self.calm_after = 3600
+        self.min_interval = 10
+        self.jitter = 0.1
+        self.green_since = None
+        self.overruns = 0
+        self.deadline = None
+
+    def interval(self, now: float) -> float:
+        '''Seconds from the start of one cycle to the start of the next.'''
+        interval = float(self.bidi.refresh)
+        code = self.bidi.status.statuscode
+        if code in self.degraded:
+            interval *= self.degraded_factor
+        elif code == 1 and self.green_since is not None and now - self.green_since >= self.calm_after:
+            interval *= self.calm_factor
+        interval *= 1 + self.jitter * (2 * self.rng() - 1)
+        return max(interval, self.min_interval)
+
+    def observe(self, started: float) -> None:
+        '''Tracks how long the status has been green.'''
+        if self.bidi.status.statuscode != 1:
+            self.green_since = None
+        elif self.green_since is None:
+            self.green_since = started
+
+    async def run(self) -> None:
+        self.deadline = self.clock()
+        while True:
+            delay = self.deadline - self.clock()
+            if delay > 0:
+                await self.sleep(delay)
+
+            started = self.clock()
+            try:
+                await self.bidi.update()
+            except Exception:  # noqa: W0703
+                log.exception('Update cycle failed')
+            self.observe(started)
+
+            finished = self.clock()
+            deadline = started + self.interval(started)
+            if deadline < finished + self.min_interval:
+                if deadline < finished:
+                    self.overruns += 1
+                    log.warn('Update overran its slot', seconds=round(finished - started, 2))
+                deadline = finished + self.min_interval
+            self.deadline = deadline
+            self.bidi.notify()
@@ -0,0 +1,64 @@
+'''The last known state on disk, so a restarted server answers with it before its first scrape.'''
+
+import os
+
+import orjson
+
+from bankid.warden import Warden
+
+log = Warden()
+
+
+class StateFile:
+    '''Writes BankID.snapshot() to path whenever the status or a scrape time changed, and reads it back at startup.
+
+    The timeline is left out, status.db already has it. Sources restored from the file are marked
+    stale in /api until they have been scraped again.
+    '''
+
+    fields = {'version', 'status', 'api', 'openapi', 'updated', 'parses', 'deadline'}
+
+    def __init__(self, bidi, path: str = 'state.json'):
+        self.bidi = bidi
+        self.path = path
+        self.written = None
+
+    def save(self) -> None:
+        '''Update cycle observer, writes the snapshot if it changed since the last write.'''
+        key = (self.bidi.version, *self.bidi.updated.values())
+        if key == self.written:
+            return
+        snapshot = self.bidi.snapshot()
+        del snapshot['timeline']
+        temporary = f'{self.path}.tmp'
+        try:
+            with open(temporary, 'wb') as state:
+                state.write(orjson.dumps(snapshot))
+            os.replace(temporary, self.path)
+        except OSError:
+            log.exception('Unable to write the state file')
+            return
+        self.written = key
+
+    async def load(self) -> bool:
+        '''Restores the state from the file if there is one, returns whether it did.'''
+        try:
+            with open(self.path, 'rb') as state:
+                snapshot = orjson.loads(state.read())
+        except FileNotFoundError:
+            return False
+        except (OSError, orjson.JSONDecodeError):
+            log.exception('Unable to read the state file, starting cold')
+            return False
+        if not isinstance(snapshot, dict) or not self.fields <= snapshot.keys():
+            log.warn('The state file does not match this version, starting cold')
+            return False
+        try:
+            await self.bidi.restore(snapshot)
+        except TypeError:
+            log.exception('The state file does not match this version, starting cold')
+            return False
+        self.bidi.stale = {source for source, updated in self.bidi.updated.items() if updated is not None}
+        self.written = (self.bidi.version, *self.bidi.updated.values())
+        log.info('Restored the last known status', status=self.bidi.status.statuscode, version=self.bidi.version)
+        return True
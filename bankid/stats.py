@@ -1,38 +1,79 @@
+import asyncio
 import sqlite3
 import time
+from array import array
+
+from bankid import metrics
+from bankid.db import Database, Pool
+from bankid.warden import Warden
 
 # from bankid.slack import Slack
 import datetime
 
+log = Warden()
+
 
 class Stats:
-    def __init__(self, db: sqlite3.Connection):
+    '''Request counters. Increments are kept in memory and written to the stats table in a single
+    transaction every flush_interval seconds and at shutdown, so a crash loses at most that window.'''
+
+    flush_interval = 5
+
+    def __init__(self, db: Database):
         self.db = db
-        self.connect = db.conn
-        self.cursor = db.cursor
+        self.pool = db.pool
+        self.pending = {'hits': 0, 'success': 0, 'failed': 0, 'errors': 0}
+        # Increments taken out of pending by a flush whose write has not committed yet.
+        self.flushing = {'hits': 0, 'success': 0, 'failed': 0, 'errors': 0}
         # self.slack = Slack()
 
     async def unauthorized(self):
         '''Increases the Failed ticker by one.'''
-        self.cursor.execute('UPDATE stats SET failed = failed + 1 WHERE stat = stat;')
+        self.pending['failed'] += 1
         await self.hits()
-        self.connect.commit()
 
     async def hits(self):
         '''Increases hit counter by one.'''
-        self.cursor.execute('UPDATE stats SET hits = hits +1 WHERE stat = stat;')
+        self.pending['hits'] += 1
 
     async def authorized(self):
         '''Increases the success counter by 1'''
-        self.cursor.execute('UPDATE stats SET success = success + 1 WHERE stat = stat;')
+        self.pending['success'] += 1
         await self.hits()
-        self.connect.commit()
 
     async def errors(self):
         '''Increases the error counter'''
-        self.cursor.execute('UPDATE stats SET errors = errors +1 WHERE stat = stat;')
+        self.pending['errors'] += 1
         await self.hits()
-        self.connect.commit()
+
+    async def flush(self) -> None:
+        '''Writes the pending increments to the database.'''
+        pending = self.pending
+        if not any(pending.values()):
+            return
+        self.pending = {'hits': 0, 'success': 0, 'failed': 0, 'errors': 0}
+        # The shutdown flush can overlap the one from flushloop, so each adds and removes its own share.
+        for counter, value in pending.items():
+            self.flushing[counter] += value
+        try:
+            await self.pool.write(
+                'UPDATE stats SET hits = hits + ?, success = success + ?, failed = failed + ?, errors = errors + ?'
+                ' WHERE stat = stat;',
+                (pending['hits'], pending['success'], pending['failed'], pending['errors']),
+            )
+        except sqlite3.Error:
+            log.exception('Unable to flush stats, keeping them for the next attempt')
+            for counter, value in pending.items():
+                self.pending[counter] += value
+        finally:
+            for counter, value in pending.items():
+                self.flushing[counter] -= value
+
+    async def flushloop(self) -> None:
+        '''Flushes the pending increments every flush_interval seconds.'''
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
 
     async def changestatus(self, color=None, reason=None):
         '''Registers a status change'''
@@ -47,7 +88,7 @@ class Stats:
         # }
 
         now = int(time.time())
-        data = self.cursor.execute('SELECT color FROM status WHERE status = ?;', ('ongoing',)).fetchone()
+        data = (await self.pool.read('SELECT color FROM status WHERE status = ?;', ('ongoing',)) or [None])[0]
 
         # if color != data[0]:
         #    self.slack.send(
@@ -58,97 +99,291 @@ class Stats:
 
         if data and color != data[0]:
 
-            self.cursor.execute("UPDATE status SET status = ?, endtime = ? WHERE status = ?;", ('ended', now, 'ongoing'))
+            await self.pool.write("UPDATE status SET status = ?, endtime = ? WHERE status = ?;", ('ended', now, 'ongoing'))
 
         elif color == data[0]:
             return
         else:
 
-            self.cursor.execute(
+            await self.pool.write(
                 'INSERT INTO status (status, starttime, endtime, color, reasoning) VALUES(?, ?, ?, ?, ?);',
                 ('ongoing', now, 'null', color, reason),
             )
 
-        self.connect.commit()
-
     async def get_stats(self):
-        '''Returns raw database data from stats table'''
+        '''Returns database data from stats table, including increments that are not written yet'''
 
         sql = 'SELECT * FROM stats WHERE stat = "stat";'
-        return self.cursor.execute(sql).fetchone()
+        rows = await self.pool.read(sql)
+        if not rows:
+            return None
+        row = rows[0]
+        stat, hits, success, failed, errors = row
+        pending = {counter: value + self.flushing[counter] for counter, value in self.pending.items()}
+        return stat, hits + pending['hits'], success + pending['success'], failed + pending['failed'], errors + pending['errors']
 
 
 class Timeline:
-    '''Asyncio worker that keeps track of the last 186 hours for historic timeline'''
+    '''Keeps the status history as intervals, and the last 168 hours in memory for the historic timeline.
+
+    An interval is a run of identical samples, (start, until, color, status). A sample that repeats
+    the open interval only moves its end in memory; the end is written every checkpoint_interval
+    seconds, when the hour view changes and at shutdown. A new row is only written when the color or
+    the text changes.
+    '''
+
+    # Severity order used when several colors were seen within the same hour. Yellow is
+    # deliberately left out, it has never been drawn on the timeline.
+    severity = ('red', 'orange', 'green', 'blue', 'black', 'grey')
+    slots = 168
+    # A sample this long after the previous one opens a new interval even if nothing changed, so
+    # time when the service itself was down does not show up as hours of the old color.
+    gap = 7200
+    checkpoint_interval = 600
+
+    def __init__(self, path: str = 'status.db'):
+        self.pool = Pool(path)
+        self.pool.write_blocking(
+            'CREATE TABLE IF NOT EXISTS intervals'
+            ' (id INTEGER PRIMARY KEY, start INTEGER, until INTEGER, color CHAR, status CHAR);'
+        )
+        self.pool.write_blocking('CREATE INDEX IF NOT EXISTS intervals_until ON intervals (until);')
+        self.pool.write_blocking(
+            'CREATE TABLE IF NOT EXISTS hourly (hour INTEGER PRIMARY KEY, time INTEGER, status CHAR, color CHAR, rank INTEGER);'
+        )
+
+        # Ring buffer with one slot per hour of the week, indexed by hour number modulo 168.
+        # A slot holds the hour it belongs to, the severity rank + 1 (0 is empty) and an index
+        # into the interned status texts, so the whole week fits in a few kilobytes.
+        self.hours = array('q', bytes(8 * self.slots))
+        self.ranks = bytearray(self.slots)
+        self.texts = array('H', bytes(2 * self.slots))
+        self.labels = [''] * self.slots
+        self.strings: list[str] = []
+        self.string_ids: dict[str, int] = {}
+        # Goes up every time a slot changes, so renders of the timeline can be cached.
+        self.version = 0
+        # The latest interval as [id, start, until, color, status], and when its end was last written.
+        self.open: list = None
+        self.checkpointed = 0
+        self.migrate()
+        self.load()
+
+    def window(self, now: int = None) -> tuple[int, int]:
+        '''The first and the last hour of the week shown on the timeline.'''
+        now = int(time.time()) if now is None else now
+        current = now - now % 3600
+        return current - (self.slots - 1) * 3600, current
+
+    def spans(self, start: int, until: int, status: str, color: str, first: int = None, last: int = None):
+        '''Yields (hour, time, status, rank) for every hour the interval covers, between first and last if given.'''
+        rank = self.severity.index(color) if color in self.severity else None
+        if rank is None:
+            return
+        begin = start - start % 3600 if first is None else max(first, start - start % 3600)
+        end = until - until % 3600 if last is None else min(last, until - until % 3600)
+        for hour in range(begin, end + 1, 3600):
+            yield hour, max(start, hour), status, rank
+
+    def load(self, now: int = None) -> None:
+        '''Fills the ring buffer with the last week from the intervals and the hourly rollup, blocking. Used at startup.'''
+        first, last = self.window(now)
+        for hour, _time, status, rank in self.pool.read_blocking(
+            'SELECT hour, time, status, rank FROM hourly WHERE hour BETWEEN ? AND ?;', (first, last)
+        ):
+            self._store(hour, _time, status, rank)
+        intervals = self.pool.read_blocking(
+            'SELECT id, start, until, color, status FROM intervals WHERE until >= ? ORDER BY id;', (first,)
+        )
+        for _id, start, until, color, status in intervals:
+            for hour, _time, text, rank in self.spans(start, until, status, color, first, last):
+                self._store(hour, _time, text, rank)
+        latest = self.pool.read_blocking('SELECT id, start, until, color, status FROM intervals ORDER BY id DESC LIMIT 1;')
+        self.open = list(latest[0]) if latest else None
+        self.checkpointed = self.open[2] if latest else 0
+
+    def _intern(self, status: str) -> int:
+        if status not in self.string_ids:
+            self.string_ids[status] = len(self.strings)
+            self.strings.append(status)
+        return self.string_ids[status]
 
-    def __init__(self):
-        self.conn = sqlite3.connect('status.db')
-        self.cursor = self.conn.cursor()
+    def _store(self, hour: int, _time: int, status: str, rank: int) -> bool:
+        slot = hour // 3600 % self.slots
+        if self.hours[slot] == hour and 0 < self.ranks[slot] <= rank + 1:
+            return False
+        self.version += 1
+        self.hours[slot] = hour
+        self.ranks[slot] = rank + 1
+        self.texts[slot] = self._intern(status)
+        self.labels[slot] = self.e2t(_time)
+        return True
 
-    def put(self, status, color):
-        query = 'INSERT INTO status (status, color) VALUES(?, ?);'
-        self.cursor.execute(query, (status, color))
-        self.conn.commit()
+    def _rollup(self, conn, intervals) -> None:
+        '''Rebuilds the hourly rows covered by intervals. Only a strictly worse color replaces an hour that
+        is already there, so hours partly covered by intervals that have been pruned keep their worst.'''
+        if not intervals:
+            return
+        best = {}
+        for start, until, color, status in intervals:
+            for hour, _time, text, rank in self.spans(start, until, status, color):
+                if hour not in best or rank < best[hour][3]:
+                    best[hour] = (hour, _time, text, rank)
+        conn.execute('DELETE FROM hourly WHERE hour > ?;', (min(interval[0] for interval in intervals),))
+        conn.executemany(
+            """
+            INSERT INTO hourly (hour, time, status, color, rank) VALUES(?, ?, ?, ?, ?)
+            ON CONFLICT(hour) DO UPDATE SET
+                time = excluded.time, status = excluded.status, color = excluded.color, rank = excluded.rank
+            WHERE excluded.rank < hourly.rank;
+            """,
+            [(hour, _time, status, self.severity[rank], rank) for hour, _time, status, rank in best.values()],
+        )
+
+    def migrate(self) -> int:
+        '''Turns the raw rows of the old status table into intervals and the hourly rollup, then empties it.
+        Blocking, runs at startup. Returns the number of intervals created.'''
+        if not self.pool.read_blocking("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'status';"):
+            return 0
+        intervals = []
+        for _time, status, color in self.pool.read_blocking('SELECT time, status, color FROM status ORDER BY time, id;'):
+            if intervals and intervals[-1][2:] == [color, status] and _time - intervals[-1][1] <= self.gap:
+                intervals[-1][1] = _time
+            else:
+                intervals.append([_time, _time, color, status])
+        if not intervals:
+            return 0
+
+        def write(conn):
+            conn.executemany('INSERT INTO intervals (start, until, color, status) VALUES(?, ?, ?, ?);', intervals)
+            conn.execute('DELETE FROM status;')
+            self._rollup(conn, intervals)
+
+        self.pool.transaction_blocking(write)
+        log.info('Migrated the status history to intervals', intervals=len(intervals))
+        return len(intervals)
+
+    async def put(self, status, color, now: int = None):
+        '''Records a status sample, extending the open interval when nothing changed.'''
+        began = time.perf_counter()
+        now = int(time.time()) if now is None else now
+        current = self.open
+        if current is not None and current[3:] == [color, status] and 0 <= now - current[2] <= self.gap:
+            # Every hour between the previous sample and this one is covered by the interval.
+            spans = self.spans(current[2], now, status, color)
+            current[2] = now
+            opened = None
+        else:
+            spans = self.spans(now, now, status, color)
+            opened = [None, now, now, color, status]
+            self.open = opened
+        changed = [
+            (hour, _time, status, color, rank) for hour, _time, status, rank in spans if self._store(hour, _time, status, rank)
+        ]
+        if opened is None and not changed and now - self.checkpointed < self.checkpoint_interval:
+            metrics.timeline_put.observe(time.perf_counter() - began)
+            return
+
+        def write(conn):
+            if current is not None:
+                conn.execute('UPDATE intervals SET until = ? WHERE id = ?;', (current[2], current[0]))
+            if opened is not None:
+                opened[0] = conn.execute(
+                    'INSERT INTO intervals (start, until, color, status) VALUES(?, ?, ?, ?);', (now, now, color, status)
+                ).lastrowid
+            if changed:
+                # Only a strictly worse color replaces what the hour already holds, so the
+                # earliest sample of the worst color is the one that is kept.
+                conn.executemany(
+                    """
+                    INSERT INTO hourly (hour, time, status, color, rank) VALUES(?, ?, ?, ?, ?)
+                    ON CONFLICT(hour) DO UPDATE SET
+                        time = excluded.time, status = excluded.status, color = excluded.color, rank = excluded.rank
+                    WHERE excluded.rank < hourly.rank;
+                    """,
+                    changed,
+                )
+
+        self.checkpointed = now
+        await self.pool.transaction(write)
+        metrics.timeline_put.observe(time.perf_counter() - began)
+
+    async def checkpoint(self) -> None:
+        '''Writes the end of the open interval, used at shutdown. Never moves the end backwards, in case
+        another process has extended the interval since this one loaded it.'''
+        current = self.open
+        if current is not None and current[0] is not None:
+            await self.pool.write('UPDATE intervals SET until = MAX(until, ?) WHERE id = ?;', (current[2], current[0]))
+            self.checkpointed = current[2]
+
+    async def backfill(self) -> int:
+        '''Rebuilds the hourly rollup from the intervals. Hours from before the oldest interval, which
+        retention has already pruned, are left as they are.'''
+
+        def write(conn):
+            self._rollup(conn, conn.execute('SELECT start, until, color, status FROM intervals ORDER BY start, id;').fetchall())
+
+        await self.pool.transaction(write)
+        first, last = self.window()
+        for hour, _time, status, rank in await self.pool.read(
+            'SELECT hour, time, status, rank FROM hourly WHERE hour BETWEEN ? AND ?;', (first, last)
+        ):
+            self._store(hour, _time, status, rank)
+        return (await self.pool.read('SELECT COUNT(*) FROM hourly;'))[0][0]
+
+    def snapshot(self) -> dict:
+        '''The ring buffer as plain data.'''
+        return {
+            'hours': self.hours.tolist(),
+            'ranks': list(self.ranks),
+            'texts': self.texts.tolist(),
+            'labels': self.labels,
+            'strings': self.strings,
+        }
+
+    def restore(self, snapshot: dict) -> None:
+        '''Replaces the ring buffer with a snapshot() from another process.'''
+        if snapshot == self.snapshot():
+            return
+        self.version += 1
+        self.hours = array('q', snapshot['hours'])
+        self.ranks = bytearray(snapshot['ranks'])
+        self.texts = array('H', snapshot['texts'])
+        self.labels = snapshot['labels']
+        self.strings = snapshot['strings']
+        self.string_ids = {status: n for n, status in enumerate(self.strings)}
 
     def e2t(self, n: int) -> datetime:
         return datetime.datetime.fromtimestamp(n).strftime('%Y-%m-%d %H:59:59')
 
-    def query(self):
-        now = int(self.cursor.execute("SELECT strftime('%s', 'now') as INT").fetchone()[0])
-        first = now - 604800
-
-        start = first
-        end = start + 3600
-        c = 0
-
-        query = """
-            SELECT
-                time, status, color
-            FROM
-                status
-            WHERE
-                time
-            BETWEEN
-                ?
-            AND
-                ?
-        """
-
-        for _ in range(first, now, 3600):
-            # Inside the hour..
-
-            results = self.cursor.execute(query, (start, end)).fetchall()
-            dict_results = {'red': [], 'orange': [], 'yellow': [], 'green': [], 'blue': [], 'black': []}
-            for x in reversed(results):
-                _time, status, color = x
-                dict_results[color] = status, _time
-
-            for k, v in dict_results.items():
-                if k == 'red' and len(v) > 0:
-                    yield {'time': str(self.e2t(v[1])), 'color': k, 'status': v[0]}
-                    break
-                elif k == 'orange' and len(v) > 0:
-                    yield {'time': str(self.e2t(v[1])), 'color': k, 'status': v[0]}
-                    break
-                elif k == 'blue' and len(v) > 0:
-                    yield {'time': str(self.e2t(v[1])), 'color': k, 'status': v[0]}
-                    break
-                elif k == 'green' and len(v) > 0:
-                    yield {'time': str(self.e2t(v[1])), 'color': k, 'status': v[0]}
-                    break
-                elif k == 'grey' and len(v) > 0:
-                    yield {'time': str(self.e2t(v[1])), 'color': k, 'status': v[0]}
-                    break
-                elif k == 'black' and len(v) > 0:
-                    yield {'time': str(self.e2t(v[1])), 'color': k, 'status': v[0]}
-                    break
-
-            start += 3600
-            end += 3600
-            c += 1
+    def query(self, now: int = None) -> list[dict]:
+        '''The worst color seen for each of the last 168 hours, from the ring buffer.'''
+        began = time.perf_counter()
+        now = int(time.time()) if now is None else now
+        current = now - now % 3600
+        hours, ranks = self.hours, self.ranks
+
+        result = []
+        for hour in range(current - (self.slots - 1) * 3600, current + 1, 3600):
+            slot = hour // 3600 % self.slots
+            if hours[slot] == hour and ranks[slot]:
+                result.append(
+                    {
+                        'time': self.labels[slot],
+                        'color': self.severity[ranks[slot] - 1],
+                        'status': self.strings[self.texts[slot]],
+                    }
+                )
+        metrics.timeline_query.observe(time.perf_counter() - began)
+        return result
 
 
 if __name__ == "__main__":
+    import sys
+
     _test = Timeline()
-    for _testy in _test.query():
-        print(_testy)
+    if sys.argv[1:] == ['backfill']:
+        print(f'Backfilled {asyncio.run(_test.backfill())} hours into the rollup.')
+    else:
+        for _testy in _test.query():
+            print(_testy)
@@ -1,3 +1,4 @@
+import time
 from typing import Any
 
 from bankid.warden import Warden
@@ -5,28 +6,71 @@ from bankid.warden import Warden
 log = Warden()
 
 
+class KeyCache:
+    '''Every api key in memory, so a lookup never reaches sqlite, however many bad keys come in.
+
+    The users table is small, so all of it is loaded and then loaded again whenever it has changed,
+    which triggers on it count in users_version, checked at most every recheck seconds. The stats
+    table lives in the same file, so PRAGMA data_version would move on every stats flush of every
+    worker. hits are lookups of known keys and misses of unknown ones.
+    '''
+
+    def __init__(self, recheck: float = 1):
+        self.recheck = recheck
+        self.entries: dict[str, list] = None
+        self.version = None
+        self.checked = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self) -> None:
+        '''Loads the keys again on the next lookup.'''
+        self.entries = None
+
+    async def validate(self, pool, now: float) -> None:
+        '''Loads the keys if they have not been loaded or the users table has been changed since.'''
+        if self.entries is not None and now - self.checked < self.recheck:
+            return
+        self.checked = now
+        version = (await pool.read('SELECT version FROM users_version;'))[0][0]
+        if self.entries is not None and version == self.version:
+            return
+        entries = {}
+        for row in await pool.read('SELECT * FROM users;'):
+            entries.setdefault(row[0], []).append(row)
+        self.entries, self.version = entries, version
+
+    def get(self, key) -> list:
+        '''The users rows for key, empty when the key is unknown.'''
+        rows = self.entries.get(key)
+        if rows is None:
+            self.misses += 1
+            return []
+        self.hits += 1
+        return rows
+
+
 class Users:
     def __init__(self, db):
-        self.cursor = db.cursor
+        self.pool = db.pool
+        self.cache: KeyCache = db.keys
         self.user = None
 
-    def sql(self, key) -> Any:
+    async def sql(self, key) -> Any:
 
-        """Requests the user data from the database"""
-        sql = 'SELECT * FROM users WHERE key = ?'
-        data = self.cursor.execute(
-            sql,
-            [
-                key,
-            ],
-        )
-        return data.fetchall()
+        """Requests the user data from the cache, which holds every key"""
+        await self.cache.validate(self.pool, time.monotonic())
+        return self.cache.get(key)
 
-    def check(self, key) -> bool:
-        '''Checks if key is in database'''
+    async def check(self, key) -> bool:
+        '''Checks if key is in database and has not expired'''
 
-        data = self.sql(key)
+        data = await self.sql(key)
         if data and len(data) == 1:
+            expire = data[0][5]
+            if expire is not None and 0 <= expire <= time.time():
+                log.debug('Api key has expired', user=data[0][1], expire=expire)
+                return False
             self.user = data[0]
             return True
         elif data and len(data) > 1:
@@ -35,7 +79,7 @@ class Users:
         return False
 
     def add(self, **user) -> None:
-        pass
+        self.cache.invalidate()
 
 
 class classy:
@@ -1,8 +1,15 @@
 '''Warden is a singleton structlogger. '''
 
+import atexit
+import datetime
+import hashlib
 import logging
 import os
+import queue
+import reprlib
 import sys
+import threading
+import time
 from traceback import walk_tb
 from types import TracebackType
 from typing import Any, Optional, Type, Union
@@ -62,11 +69,37 @@ class Warden:
 
     log: structlog.BoundLogger = structlog.get_logger()
 
+    # Queue mode, LOG_QUEUE=1: events are rendered and written in batches by a background thread.
+    # When the queue is full new events are dropped and counted, or with LOG_QUEUE_FULL=block the
+    # caller waits for room.
+    queue_size: int = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+    queue_full: str = os.getenv('LOG_QUEUE_FULL', 'drop')
+    batch_size: int = 256
+    # Seconds between the summaries of events logged with count().
+    count_interval: float = 60.0
+    # An exception with the same type and frames as one logged before is only counted, and summed up
+    # with count(), until it has not been seen for exception_quiet seconds.
+    exception_quiet: float = 600.0
+    max_fingerprints: int = 1000
+    # Locals captured per event: names per frame, innermost frames with locals, and characters in all.
+    locals_max_count: int = 20
+    locals_max_frames: int = 5
+    locals_max_total: int = 4096
+
     instance = None
+    events: queue.SimpleQueue = None
 
     def __new__(cls):
         if cls.instance is None:
             cls.instance = super().__new__(cls)
+            cls.instance.dropped = 0
+            cls.instance.counts = {}
+            cls.instance.counted = time.monotonic()
+            cls.instance.counts_lock = threading.Lock()
+            cls.instance.fingerprints = {}
+            cls.instance.reprs = reprlib.Repr()
+            cls.instance.reprs.maxstring = cls.instance.reprs.maxother = 200
+            cls.instance.exceptions = {'logged': 0, 'suppressed': 0}
         return cls.instance
 
     def __init__(self):
@@ -100,7 +133,8 @@ class Warden:
             obj_repr = obj
         else:
             try:
-                obj_repr = repr(obj)
+                # reprlib stops at a few items per container, so a huge local costs no more than a small one.
+                obj_repr = self.reprs.repr(obj)
             except Exception as error:
                 obj_repr = f"<repr-error {str(error)!r}>"
 
@@ -133,6 +167,7 @@ class Warden:
         locals_max_string = self.locals_max_string
         stacks: list[Stack] = []
         is_cause = False
+        budget = self.locals_max_total
 
         while True:
             stack = Stack(
@@ -153,19 +188,25 @@ class Warden:
             stacks.append(stack)
             append = stack.frames.append  # pylint: disable=no-member
 
-            for frame_summary, line_no in walk_tb(traceback):
+            walked = list(walk_tb(traceback))
+            for depth, (frame_summary, line_no) in enumerate(walked):
                 filename = frame_summary.f_code.co_filename
                 if filename and not filename.startswith("<"):
                     filename = os.path.abspath(filename)
+                frame_locals = None
+                # Locals of the innermost frames only, and no more than the budget left for the event.
+                if self.show_locals and len(walked) - depth <= self.locals_max_frames and budget > 0:
+                    frame_locals = {}
+                    for key, value in list(frame_summary.f_locals.items())[:self.locals_max_count]:
+                        frame_locals[key] = self._to_repr(value, max_string=min(locals_max_string or budget, budget))
+                        budget -= len(key) + len(frame_locals[key])
+                        if budget <= 0:
+                            break
                 frame = Frame(
                     filename=filename or "?",
                     lineno=line_no,
                     name=frame_summary.f_code.co_name,
-                    locals={
-                        key: self._to_repr(value, max_string=locals_max_string) for key, value in frame_summary.f_locals.items()
-                    }
-                    if self.show_locals
-                    else None,
+                    locals=frame_locals,
                 )
                 append(frame)
 
@@ -222,6 +263,7 @@ class Warden:
         These dictionaries are based on :cls:`Stack` instances generated by
         :func:`extract()` and can be dumped to JSON.
         """
+        max_frames = self.max_frames if max_frames is None else max_frames
         if self.locals_max_string < 0:
             raise ValueError(f'"locals_max_string" must be >= 0: {locals_max_string}')
         if self.max_frames < 2:
@@ -269,29 +311,39 @@ class Warden:
 
     def _init(self):
 
+        structured = os.getenv('ENV') in ['production', 'prod', 'test', 'testing'] or os.getenv('JSON', '0') == '1'
+        if os.getenv('CONSOLE', '0') == '1':
+            structured = False
+
         processors = [
             self._how_we_work,
             structlog.processors.TimeStamper(fmt='iso'),
             structlog.processors.add_log_level,
 
             structlog.processors.StackInfoRenderer(),
-            structlog.processors.format_exc_info,
             structlog.processors.UnicodeDecoder(),
 
         ]
-        render = structlog.dev.ConsoleRenderer()
-        if os.getenv('ENV') in ['production', 'prod', 'test', 'testing']:
-            render = self.__render_orjson
-        if os.getenv('JSON', '0') == '1':
-            render = self.__render_orjson
-        if os.getenv('CONSOLE', '0') == '1':
-            render = structlog.dev.ConsoleRenderer()
-
-        processors.append(render)
+        if structured:
+            # exc_info is left for the renderer, which turns it into the structured trace with the locals caps.
+            processors.append(self.__render_orjson)
+        else:
+            processors.insert(4, structlog.processors.format_exc_info)
+            processors.append(structlog.dev.ConsoleRenderer())
+
+        queued = os.getenv('LOG_QUEUE', '0') == '1'
+        if queued:
+            # Only the time is taken on the calling thread, everything else runs on the writer thread.
+            processors[1] = self._stamp
+            self._background = processors
+            processors = [self._enqueue]
+            self._start_writer()
+        processors.insert(0, self._dedupe)
 
         structlog.configure(
             wrapper_class=structlog.make_filtering_bound_logger(self.loglevel),
             processors=processors,
+            cache_logger_on_first_use=queued,
 
         )
         formatter = structlog.stdlib.ProcessorFormatter(
@@ -304,6 +356,154 @@ class Warden:
         if self.catch_all:
             sys.excepthook = self._handle_exception
 
+    def _fingerprint(self, exc_info: ExcInfo) -> str:
+        '''Hash of the exception types and the frames they passed through, following causes and contexts.'''
+        parts = []
+        exc_value = exc_info[1]
+        seen = set()
+        while exc_value is not None and id(exc_value) not in seen:
+            seen.add(id(exc_value))
+            parts.append(type(exc_value).__qualname__)
+            parts.extend(
+                f'{frame.f_code.co_filename}:{frame.f_code.co_name}:{line}' for frame, line in walk_tb(exc_value.__traceback__)
+            )
+            exc_value = exc_value.__cause__ or (None if exc_value.__suppress_context__ else exc_value.__context__)
+        return hashlib.blake2b('|'.join(parts).encode(), digest_size=8).hexdigest()
+
+    def _dedupe(self, _, __, event_dict):
+        '''First processor: lets the first occurrence of an exception through with its trace and a fingerprint,
+        and turns repeats into count() summaries until the fingerprint has been quiet for exception_quiet seconds.'''
+        exc_info = event_dict.get('exc_info')
+        if not exc_info:
+            return event_dict
+        exc_info = self._get_exc_info(exc_info)
+        if exc_info[1] is None:
+            return event_dict
+        event_dict['exc_info'] = exc_info
+        fingerprint = self._fingerprint(exc_info)
+        now = time.monotonic()
+        last = self.fingerprints.pop(fingerprint, None)
+        if len(self.fingerprints) >= self.max_fingerprints:
+            del self.fingerprints[next(iter(self.fingerprints))]
+        self.fingerprints[fingerprint] = now
+        if last is None or now - last > self.exception_quiet:
+            self.exceptions['logged'] += 1
+            event_dict['fingerprint'] = fingerprint
+            return event_dict
+        self.exceptions['suppressed'] += 1
+        self.count(
+            'Repeated exception',
+            message=self._safe_str(event_dict.get('event')),
+            exc_type=exc_info[0].__name__,
+            fingerprint=fingerprint,
+        )
+        raise structlog.DropEvent
+
+    def _start_writer(self):
+        '''Starts the writer thread, once per process.'''
+        if Warden.events is not None:
+            return
+        Warden.events = queue.SimpleQueue()
+        threading.Thread(target=self._writer, name='warden-writer', daemon=True).start()
+        atexit.register(self._stop_writer)
+
+    def _enqueue(self, logger, method_name, event_dict):
+        '''Last processor in queue mode: hands the event to the writer thread instead of rendering it.'''
+        event_dict['_stamp'] = time.time()
+        # The writer thread has no exception or stack of its own to look at.
+        if event_dict.get('exc_info') is True:
+            event_dict['exc_info'] = sys.exc_info()
+        if event_dict.get('stack_info'):
+            event_dict = structlog.processors.StackInfoRenderer()(logger, method_name, event_dict)
+        if self.events.qsize() >= self.queue_size:
+            if self.queue_full != 'block':
+                self.dropped += 1
+                raise structlog.DropEvent
+            while self.events.qsize() >= self.queue_size:
+                time.sleep(0.001)
+        self.events.put((logger, method_name, event_dict))
+        raise structlog.DropEvent
+
+    def _stamp(self, _, __, event_dict):
+        '''TimeStamper(fmt='iso') for the time _enqueue took.'''
+        stamp = datetime.datetime.fromtimestamp(event_dict.pop('_stamp'), tz=datetime.timezone.utc)
+        event_dict['timestamp'] = stamp.isoformat().replace('+00:00', 'Z')
+        return event_dict
+
+    def _render(self, logger, method_name, event_dict, processors):
+        for processor in processors:
+            event_dict = processor(logger, method_name, event_dict)
+        return event_dict
+
+    def _writer(self):
+        '''Renders queued events and writes them out in batches, with the dropped count and the count() summaries.'''
+        reported = 0
+        running = True
+        while running:
+            batch = []
+            try:
+                batch.append(self.events.get(timeout=1))
+                while len(batch) < self.batch_size:
+                    batch.append(self.events.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                running = False
+
+            if self.dropped > reported:
+                event = {'event': 'Dropped log events, the queue was full', 'dropped': self.dropped - reported}
+                batch.append((None, 'warning', {**event, '_stamp': time.time()}))
+                reported = self.dropped
+            for event, fields, count in self._due_counts(force=not running):
+                batch.append((None, 'info', {'event': event, **fields, 'count': count, '_stamp': time.time()}))
+
+            lines = []
+            for logger, method_name, event_dict in batch:
+                try:
+                    lines.append(self._render(logger, method_name, event_dict, self._background))
+                except structlog.DropEvent:
+                    pass
+                except Exception as error:  # noqa: W0703
+                    lines.append(f'<log-render-error {self._safe_str(error)!r}>')
+            if lines:
+                try:
+                    sys.stdout.write('\n'.join(lines) + '\n')
+                    sys.stdout.flush()
+                except (OSError, ValueError):
+                    pass
+
+    def _stop_writer(self):
+        '''Writes out what is still queued when the process exits.'''
+        self.events.put(None)
+        for thread in threading.enumerate():
+            if thread.name == 'warden-writer':
+                thread.join(timeout=5)
+
+    def _due_counts(self, force: bool = False) -> list:
+        '''Takes the counts of count() events if count_interval has passed since they were last taken.'''
+        if not force and time.monotonic() - self.counted < self.count_interval:
+            return []
+        with self.counts_lock:
+            counts, self.counts = self.counts, {}
+            self.counted = time.monotonic()
+        return [(event, dict(kwargs), count) for (event, kwargs), count in counts.items()]
+
+    def count(self, msg, **kwargs) -> None:
+        '''Logs an event that happens on a hot path as a periodic summary, one info event per distinct
+        msg and kwargs with the number of times it happened since the last summary.'''
+        if self.loglevel > logging.INFO:
+            return
+        key = (msg, tuple(sorted(kwargs.items())))
+        if Warden.events is None:
+            # Without the writer thread the summaries go out from here when they are due.
+            self.counts[key] = self.counts.get(key, 0) + 1
+            for event, fields, count in self._due_counts():
+                self.log.info(event, count=count, **fields)
+            return
+        with self.counts_lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
     def _handle_exception(self, exc_type, exc_value, exc_traceback):
         '''Properly logs uncaught exceptions'''
         if issubclass(exc_type, KeyboardInterrupt):
@@ -1,24 +1,57 @@
-import aiohttp_jinja2
 import asyncio
-import jinja2
+import gzip
 import json
+import orjson
+import os
+import random
+import signal
+import threading
 import traceback
 import hashlib
 import datetime
+import time
 
 from aiohttp import web
+from bankid import metrics, profiling
 from bankid.config import Config
 from bankid.warden import Warden
 from bankid.bankid import BankID
 from bankid.classes import Auth, Api
-from bankid.stats import Stats, Timeline
+from bankid.cluster import Cluster
+from bankid.stats import Stats
 from bankid.db import Database
+from bankid.retention import Retention
+from bankid.state import StateFile
+from bankid.users import Users
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def encodings(header: str) -> set[str]:
+    '''The content codings a client accepts, leaving out the ones it sent with q=0.'''
+    accepted = set()
+    for coding in header.split(','):
+        name, *params = coding.split(';')
+        weight = next((param.strip()[2:] for param in params if param.strip().startswith('q=')), '1')
+        try:
+            if float(weight) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
 
 
 class Webserver:
 
     host: str = None
     port: str = None
+    # Longest a long-polling /api request is held open, in seconds.
+    max_wait: int = 60
+    workers: int = 1
 
     def __init__(self):
         self.log = Warden()
@@ -26,40 +59,181 @@ class Webserver:
         self.stat = Stats(self.db)
         self.bidi = BankID(self.stat)
         self.config = Config()
-        self.timeline = Timeline()
+        self.timeline = self.bidi.timeline
+        self.retention = Retention(self.timeline)
+        self.state = StateFile(self.bidi)
+        self.rendered: tuple = None
+        self.payloads: tuple = None
+        self.templates = None
+        self.templates_lock = threading.Lock()
+        self.cluster: Cluster = None
+        self.gauges()
 
-    async def run(self) -> None:
-        '''Sets up and runs an aiohttp web server with the bankid and api routes
+    def gauges(self) -> None:
+        '''Registers the metrics that are read from the server state when /metrics is rendered.'''
+        bidi, keys = self.bidi, self.db.keys
+        metrics.Gauge(
+            'bidi_status_age_seconds',
+            'Seconds since each upstream was last updated.',
+            lambda: {source: time.time() - updated for source, updated in bidi.updated.items() if updated},
+            ('source',),
+        )
+        metrics.Gauge('bidi_status_version', 'Status version, moves on every status change.', lambda: bidi.version)
+        metrics.Gauge('bidi_parses_total', 'Status page parses, full or skipped.', lambda: bidi.parses, ('kind',), 'counter')
+        metrics.Gauge(
+            'bidi_key_cache_total', 'Api key lookups.', lambda: {'hit': keys.hits, 'miss': keys.misses}, ('result',), 'counter'
+        )
+        metrics.Gauge('bidi_stream_subscribers', 'Open /stream connections.', lambda: len(bidi.broadcast.subscribers))
+        metrics.Gauge(
+            'bidi_stream_events_total',
+            'Events published to /stream, and subscribers dropped for falling behind.',
+            lambda: {'published': bidi.broadcast.published, 'dropped': bidi.broadcast.dropped},
+            ('kind',),
+            'counter',
+        )
+        metrics.Gauge(
+            'bidi_retention_pruned_total', 'Rows removed by retention.', lambda: self.retention.pruned, ('table',), 'counter'
+        )
+        metrics.Gauge(
+            'bidi_db_bytes',
+            'Used and free bytes of status.db at the last retention run.',
+            lambda: dict(zip(('used', 'free'), self.retention.sizes[-1][1:])) if self.retention.sizes else None,
+            ('kind',),
+        )
+        metrics.Gauge(
+            'bidi_log_dropped_total', 'Log events dropped because the queue was full.', lambda: self.log.dropped, kind='counter'
+        )
+        metrics.Gauge(
+            'bidi_log_exceptions_total',
+            'Exceptions logged with their trace, and repeats that were only counted.',
+            lambda: self.log.exceptions,
+            ('kind',),
+            'counter',
+        )
+        metrics.Gauge(
+            'bidi_scraper', 'Whether this worker runs the update loop.', lambda: int(self.cluster is None or self.cluster.leading)
+        )
 
-        '''
-        self.config.read(self)
-        app = web.Application()
-        loop = asyncio.get_event_loop()
-        loop.create_task(self.bidi.updateloop())
-        aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('templates'))
+    def application(self) -> web.Application:
+        '''Builds the aiohttp application with the bankid and api routes'''
+        app = web.Application(middlewares=[self.measure, self.profile])
+        app.on_cleanup.append(lambda _: self.bidi.close())
+        app.on_shutdown.append(self.bidi.broadcast.close)
 
         app.add_routes(
             [
                 web.get('/{key}/bankid', self.bankid),
                 web.get('/health', self.healthcheck),
+                web.get('/metrics', self.prometheus),
                 web.get('/{key}/api', self.api),
+                web.get('/{key}/stream', self.stream),
                 web.post('/{key}/admin', self.get_stats_post),
                 web.get('/{key}/admin', self.get_stats),
+                web.get('/{key}/admin/profile', self.profiles),
                 web.get('/', self.about),
             ]
         )
         app.make_handler(access_log=Warden)
+        return app
+
+    async def run(self, cluster: bool = False) -> None:
+        '''Sets up and runs an aiohttp web server with the bankid and api routes
+
+        With cluster set this is one of several workers sharing the port, and only the worker
+        holding the scraper lease runs the update loop and retention.
+        '''
+        self.config.read(self)
+        # Serves the last known status from the first request on, while the first scrape runs.
+        await self.state.load()
+        self.bidi.observers.append(self.state.save)
+        app = self.application()
         runner = web.AppRunner(app)
         await runner.setup()
 
-        site = web.TCPSite(runner, host=self.host, port=self.port)
+        site = web.TCPSite(runner, host=self.host, port=self.port, reuse_port=cluster or None)
         await site.start()
         self.log.info(f'Running at {self.host}:{self.port}')
-        await asyncio.Event().wait()
+        # The port is bound before anything else starts, so the first scrape and the template
+        # compile run while the server already answers.
+        loop = asyncio.get_event_loop()
+        # The loop only keeps weak references to tasks, a waiting one can be collected unless it is kept here.
+        if cluster:
+            self.cluster = Cluster(self)
+            tasks = [loop.create_task(self.cluster.run())]
+        else:
+            tasks = [loop.create_task(self.bidi.updateloop()), loop.create_task(self.retention.loop())]
+        tasks += [loop.create_task(self.stat.flushloop()), loop.create_task(metrics.monitor())]
+        loop.run_in_executor(None, self.compile)
+        # docker stop and the cluster supervisor stop the server with SIGTERM, which must reach the flush below.
+        stopped = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+        try:
+            await stopped.wait()
+        finally:
+            await self.stat.flush()
+            # A follower's open interval is the one it loaded at startup, only the scraper has the current end.
+            if self.cluster is None or self.cluster.leading:
+                await self.timeline.checkpoint()
+            await runner.cleanup()
+
+    @web.middleware
+    async def measure(self, request, handler):
+        '''Times every request per route and counts the responses per status code.'''
+        route = request.match_info.route.resource
+        route = route.canonical if route is not None else 'unmatched'
+        began = time.perf_counter()
+        code = 500
+        try:
+            response = await handler(request)
+            code = response.status
+            return response
+        except web.HTTPException as e:
+            code = e.status
+            raise
+        finally:
+            metrics.requests.observe(time.perf_counter() - began, route)
+            metrics.responses.inc((route, code))
+
+    @web.middleware
+    async def profile(self, request, handler):
+        '''Measures the stages of a request in profiling mode or when an admin asks for it, and passes it on otherwise.
+
+        Time spent long-polling does not count towards the slow threshold, and /stream is left alone.
+        '''
+        profiler = profiling.profiler
+        forced = 'profile' in request.query_string and request.query.get('profile') == '1' and await self.admin(request)
+        if not (profiler.enabled or forced) or request.path.endswith('/stream'):
+            return await handler(request)
+        stages = {}
+        token = profiling.current.set(stages)
+        profile = profiler.start() if forced or random.random() < profiler.sample else None
+        cycles = profiler.cycles
+        began = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            elapsed = time.perf_counter() - began
+            profiling.current.reset(token)
+            if profile is not None:
+                profiler.stop(profile, 'requests')
+            slow = elapsed - stages.get('wait', 0) >= profiler.slow
+            if forced or slow:
+                self.log.warn(
+                    'Slow request' if slow else 'Profiled request',
+                    path=request.path,
+                    total_ms=round(elapsed * 1000, 2),
+                    stages=profiling.breakdown(stages),
+                    during_update=profiler.updating or profiler.cycles != cycles,
+                    profiled=profile is not None,
+                )
 
     async def healthcheck(self, request):  # noqa: W0613
         return web.json_response({'running': True})
 
+    async def prometheus(self, request):  # noqa: W0613
+        '''Prometheus metrics of this worker process, no api key needed.'''
+        return web.Response(body=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
     async def about(self, request):  # noqa W0613
         '''Returns the about me dict'''
         about = {
@@ -78,7 +252,34 @@ class Webserver:
 
     async def auth(self, key):
         '''Creats an Auth Object with information about caller'''
-        return Auth(key, self.db)
+        began = time.perf_counter()
+        with profiling.stage('auth'):
+            users = Users(self.db)
+            await users.check(key)
+            auth = Auth(users)
+        metrics.auth.observe(time.perf_counter() - began)
+        return auth
+
+    async def admin(self, request) -> bool:
+        '''Whether the key in the request belongs to the admin.'''
+        auth = await self.auth(request.match_info.get('key'))
+        return auth.is_auth and 'Stian Langvann' in auth.user
+
+    async def profiles(self, request) -> web.Response:
+        '''The added up profiles of this worker, as a pstats file or as text with ?format=text. ?reset=1 starts over.'''
+        if not await self.admin(request):
+            return await self.unauthorized()
+        if request.query.get('format') == 'text':
+            response = web.Response(text=profiling.profiler.text(), content_type='text/plain')
+        else:
+            response = web.Response(
+                body=profiling.profiler.dump(),
+                content_type='application/octet-stream',
+                headers={'Content-Disposition': f'attachment; filename="bidi-{os.getpid()}.prof"'},
+            )
+        if request.query.get('reset') == '1':
+            profiling.profiler.reset()
+        return response
 
     async def get_stats_post(self, request):
         auth = await self.auth(request.match_info['key'])
@@ -108,10 +309,13 @@ class Webserver:
                         'total_success': success,
                         'total_failed': fails,
                         'errors': errors,
+                        'parses': self.bidi.parses,
+                        'pruned': self.retention.pruned,
+                        'sizes': self.retention.sizes,
                         'new_key': key.hexdigest(),
                     }
 
-                    return aiohttp_jinja2.render_template('admin.html', request, data)
+                    return web.Response(text=self.template('admin.html').render(data), content_type='text/html')
             except Exception:  # noqa: W0703
                 traceback.print_exc()
                 return await self.unauthorized()
@@ -124,11 +328,30 @@ class Webserver:
 
             await self.stat.authorized()
 
-            # Build the Api endpoint
-            response = Api({'auth': 'Authorized'}, self.bidi.api, self.bidi.openapi).__dict__
+            # Long-poll: hold the request until the status version passes since, or wait runs out
+            if 'since' in request.query:
+                try:
+                    since = int(request.query['since'])
+                    wait = min(float(request.query.get('wait', self.max_wait)), self.max_wait)
+                except ValueError:
+                    return web.json_response({'message': 'since and wait must be numbers'}, status=400)
+                if self.bidi.version <= since and wait > 0:
+                    with profiling.stage('wait'):
+                        await self.bidi.wait(since, wait)
 
-            # Returns the Api endpoint
-            return web.Response(content_type="application/json", text=str(json.dumps(response, indent=2)), status=200)
+            document, variants = self.payload()
+            headers = {'Vary': 'Accept-Encoding'}
+            if request.query.get('pretty') == '1':
+                body = orjson.dumps(document, option=orjson.OPT_INDENT_2)
+                return web.Response(body=body, content_type='application/json', headers=headers)
+
+            # Returns the smallest pre-serialized variant the caller accepts
+            accepted = encodings(request.headers.get('Accept-Encoding', ''))
+            for coding in ('br', 'gzip'):
+                if coding in variants and (coding in accepted or '*' in accepted):
+                    headers['Content-Encoding'] = coding
+                    return web.Response(body=variants[coding], content_type='application/json', headers=headers)
+            return web.Response(body=variants['identity'], content_type='application/json', headers=headers)
 
         # or return the unauthorized message
         return await self.unauthorized()
@@ -139,14 +362,93 @@ class Webserver:
         if auth.is_auth:
             await self.stat.authorized()
 
-            # Returns the Jinja Document
-            bankidstatus = self.bidi.get_status()
-            data = {'data': bankidstatus.__dict__, 'timeline': self.timeline}
-            return aiohttp_jinja2.render_template('bankid.html', request, data, status=200)
+            # Returns the rendered Jinja Document, or 304 if the caller already has it
+            body, etag = self.embed(request)
+            headers = {'ETag': etag, 'Cache-Control': f'max-age={self.bidi.next_update()}'}
+            if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+                return web.Response(status=304, headers=headers)
+            return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
 
         # or returns the unauthorized message
         return await self.unauthorized()
 
+    async def stream(self, request) -> web.StreamResponse:
+        '''Handles the "stream" endpoint. Sends the bidi object, then an event for every status change.'''
+        auth = await self.auth(request.match_info['key'])
+        if not auth.is_auth:
+            return await self.unauthorized()
+        await self.stat.authorized()
+
+        broadcast = self.bidi.broadcast
+        response = web.StreamResponse(
+            headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        await response.prepare(request)
+        with broadcast.subscribe() as queue:
+            try:
+                await response.write(broadcast.event('status', self.bidi.api, self.bidi.version))
+                while True:
+                    try:
+                        event = await asyncio.wait_for(queue.get(), broadcast.heartbeat)
+                    except asyncio.TimeoutError:
+                        event = b': heartbeat\n\n'
+                    if event is None:
+                        break
+                    await response.write(event)
+            except ConnectionResetError:
+                pass
+        return response
+
+    def payload(self) -> tuple[dict, dict[str, bytes]]:
+        '''The /api document and its serialized variants, built again only when the status or a source changed.'''
+        version = (self.bidi.version, *self.bidi.updated.values())
+        if self.payloads is None or self.payloads[0] != version:
+            document = Api(
+                {'auth': 'Authorized'}, self.bidi.api, self.bidi.openapi, self.bidi.staleness(), self.bidi.version
+            ).__dict__
+            with profiling.stage('serialize'):
+                body = orjson.dumps(document)
+                variants = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+                if brotli is not None:
+                    variants['br'] = brotli.compress(body)
+            self.payloads = (version, document, variants)
+        return self.payloads[1], self.payloads[2]
+
+    def embed(self, request) -> tuple[bytes, str]:
+        '''Returns bankid.html and its ETag, rendered again only when the status, the timeline or the hour changed.'''
+        version = (self.bidi.version, self.timeline.version, int(time.time()) // 3600)
+        if self.rendered is None or self.rendered[0] != version:
+            data = {'data': self.bidi.get_status().__dict__, 'timeline': self.timeline}
+            with profiling.stage('render'):
+                body = self.template('bankid.html').render(data).encode()
+            etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+            self.rendered = (version, body, etag)
+        return self.rendered[1], self.rendered[2]
+
+    def template(self, name: str):
+        '''Returns the named template. jinja2 is imported and set up on first use, not at startup.'''
+        # A request that comes in while compile() sets up the environment waits for it.
+        with self.templates_lock:
+            if self.templates is None:
+                import jinja2
+
+                # The bytecode cache keeps the compiled templates in the temp directory across restarts.
+                self.templates = jinja2.Environment(
+                    loader=jinja2.FileSystemLoader('templates'),
+                    autoescape=True,
+                    bytecode_cache=jinja2.FileSystemBytecodeCache(),
+                )
+        return self.templates.get_template(name)
+
+    def compile(self) -> None:
+        '''Loads every template ahead of its first request, run in an executor after startup.'''
+        try:
+            self.template('bankid.html')
+            for name in self.templates.list_templates():
+                self.templates.get_template(name)
+        except Exception:  # noqa: W0703
+            self.log.exception('Unable to compile the templates')
+
     async def unauthorized(self):
         message = {'message': {'auth': 'Unauthorized'}}
 
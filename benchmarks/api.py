@@ -0,0 +1,104 @@
+'''Bytes per second produced by the /api handler, serialized per request and from the pre-serialized variants.
+
+    python3 -m benchmarks.api [requests] [components]
+
+Calls the handler directly with mocked requests, so the numbers are what the handler itself costs
+without the network. The statuspage document is a summary.json shaped stand-in with the given
+number of components and a few incidents.
+'''
+import asyncio
+import json
+import sys
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from bankid.classes import Api
+from bankid import webserver
+from bankid.warden import Warden
+from bankid.webserver import Webserver
+from benchmarks.stub import workspace
+
+
+def summary(components):
+    '''A statuspage.io summary document of roughly the size bankid-services serves.'''
+    component = {
+        'status': 'operational',
+        'created_at': '2020-05-04T08:21:41.254Z',
+        'updated_at': '2022-09-19T11:02:13.019Z',
+        'position': 1,
+        'description': 'BankID på mobil og BankID med kodebrikke, app og passord.',
+        'showcase': True,
+        'start_date': None,
+        'group_id': None,
+        'page_id': 'k1yh6pq1n4zd',
+        'group': False,
+        'only_show_if_degraded': False,
+    }
+    incident = {
+        'name': 'Redusert tilgjengelighet for BankID på mobil',
+        'status': 'resolved',
+        'impact': 'minor',
+        'incident_updates': [
+            {'status': 'resolved', 'body': 'Feilen er rettet og tjenesten fungerer som normalt igjen.' * 3}
+        ] * 4,
+    }
+    return {
+        'page': {'id': 'k1yh6pq1n4zd', 'name': 'BankID', 'url': 'https://bankid-services.statuspage.io'},
+        'components': [dict(component, id=f'c{n:011d}', name=f'Component {n}') for n in range(components)],
+        'incidents': [dict(incident, id=f'i{n:011d}') for n in range(3)],
+        'scheduled_maintenances': [],
+        'status': {'indicator': 'none', 'description': 'All Systems Operational'},
+    }
+
+
+class SerializeEveryTime(Webserver):
+    '''The previous handler, building the Api document and running json.dumps on every request.'''
+
+    async def api(self, request):
+        auth = await self.auth(request.match_info['key'])
+        if auth.is_auth:
+            await self.stat.authorized()
+            response = Api({'auth': 'Authorized'}, self.bidi.api, self.bidi.openapi, self.bidi.staleness()).__dict__
+            return web.Response(content_type="application/json", text=str(json.dumps(response, indent=2)), status=200)
+        return await self.unauthorized()
+
+
+async def measure(server, total, headers, query=''):
+    app = server.application()
+    request = make_mocked_request('GET', f'/abcd/api{query}', headers=headers, match_info={'key': 'abcd'}, app=app)
+    sent = 0
+    began = time.perf_counter()
+    for _ in range(total):
+        response = await server.api(request)
+        sent += len(response.body)
+    elapsed = time.perf_counter() - began
+    return total / elapsed, sent / elapsed, sent // total, response.headers.get('Content-Encoding', 'identity')
+
+
+def main(total='20000', components='40'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+    document = summary(int(components))
+
+    runs = (
+        ('json.dumps per request', SerializeEveryTime, {}, ''),
+        ('cached, identity', Webserver, {}, ''),
+        ('cached, gzip', Webserver, {'Accept-Encoding': 'gzip'}, ''),
+        ('cached, br', Webserver, {'Accept-Encoding': 'gzip, deflate, br'}, ''),
+        ('?pretty=1', Webserver, {}, '?pretty=1'),
+    )
+    with workspace():
+        for name, server, headers, query in runs:
+            if 'br' in headers.get('Accept-Encoding', '') and webserver.brotli is None:
+                print(f'{name:24} skipped, brotli is not installed')
+                continue
+            server = server()
+            server.bidi.openapi = document
+            rate, throughput, size, coding = asyncio.run(measure(server, int(total), headers, query))
+            print(f'{name:24} {rate:9.0f} req/s {throughput / 2**20:9.1f} MiB/s   {size:6} bytes {coding}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,68 @@
+'''Auth lookups per second without the users.key index, with it, and with every key held in memory.
+
+    python3 -m benchmarks.auth [users] [lookups]
+
+Seeds a copy of users.db with extra users, then authenticates with a valid key, repeats one bad
+key (a flood of the same wrong key) and sends a different random key each time.
+'''
+import asyncio
+import secrets
+import sys
+import time
+
+from bankid.classes import Auth
+from bankid.db import Database
+from bankid.users import Users
+from bankid.warden import Warden
+from benchmarks.stub import workspace
+
+
+def seed(db, count):
+    users = [(secrets.token_hex(20), f'user {n}', f'{n}@example.com', '', 'free_account', -1) for n in range(count)]
+    db.pool.write_blocking('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?);', users, many=True)
+    return users[count // 2][0]
+
+
+class Uncached(Users):
+    '''Looks every key up in sqlite, the way it was done before the key cache.'''
+
+    async def sql(self, key):
+        return await self.pool.read('SELECT * FROM users WHERE key = ?', [key])
+
+
+async def authenticate(db, keys, lookups, lookup):
+    for n in range(lookups):
+        users = lookup(db)
+        await users.check(keys(n))
+        Auth(users)
+
+
+def throughput(db, keys, lookups, lookup=Users):
+    began = time.perf_counter()
+    asyncio.run(authenticate(db, keys, lookups, lookup))
+    return lookups / (time.perf_counter() - began)
+
+
+def main(users='5000', lookups='20000'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+
+    with workspace('users.db'):
+        db = Database()
+        valid = seed(db, int(users))
+        patterns = {
+            'valid key': lambda n: valid,
+            'same bad key': lambda n: 'not-a-key',
+            'random bad keys': lambda n: secrets.token_hex(8),
+        }
+        for name, keys in patterns.items():
+            db.pool.write_blocking('DROP INDEX users_key;')
+            before = throughput(db, keys, int(lookups), Uncached)
+            db.pool.write_blocking('CREATE INDEX users_key ON users (key);')
+            indexed = throughput(db, keys, int(lookups), Uncached)
+            cached = throughput(db, keys, int(lookups))
+            print(f'{name:16} no index {before:9.0f}/s   indexed {indexed:9.0f}/s   cached {cached:9.0f}/s')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,72 @@
+'''Requests per second for /{key}/bankid rendered on every request, served from the cache, and answered with 304.
+
+    python3 -m benchmarks.embed [requests] [concurrency]
+'''
+import asyncio
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from bankid.warden import Warden
+from bankid.webserver import Webserver
+from benchmarks.stub import workspace
+
+
+class RenderEveryTime(Webserver):
+    '''The previous handler, rendering the template through Jinja for every request.'''
+
+    def embed(self, request):
+        data = {'data': self.bidi.get_status().__dict__, 'timeline': self.timeline}
+        return self.template('bankid.html').render(data).encode(), '"uncached"'
+
+
+async def hammer(url, total, concurrency, headers=None):
+    statuses = {}
+
+    async def client(session, count):
+        for _ in range(count):
+            async with session.get(url, headers=headers) as r:
+                await r.read()
+                statuses[r.status] = statuses.get(r.status, 0) + 1
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        began = time.perf_counter()
+        await asyncio.gather(*(client(session, total // concurrency) for _ in range(concurrency)))
+        return total / (time.perf_counter() - began), statuses
+
+
+async def serve(server, total, concurrency, conditional=False):
+    runner = web.AppRunner(server.application())
+    await runner.setup()
+    site = web.TCPSite(runner, host='127.0.0.1', port=0)
+    await site.start()
+    url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/abcd/bankid'
+    try:
+        headers = None
+        if conditional:
+            async with aiohttp.ClientSession() as session, session.get(url) as r:
+                headers = {'If-None-Match': r.headers['ETag']}
+        return await hammer(url, total, concurrency, headers)
+    finally:
+        await runner.cleanup()
+
+
+def main(total='5000', concurrency='20'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+
+    runs = (
+        ('render every request', RenderEveryTime, False),
+        ('cached 200', Webserver, False),
+        ('cached 304', Webserver, True),
+    )
+    for name, server, conditional in runs:
+        with workspace():
+            rate, statuses = asyncio.run(serve(server(), int(total), int(concurrency), conditional))
+        print(f'{name:22} {rate:8.0f} req/s   {statuses}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
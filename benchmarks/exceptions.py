@@ -0,0 +1,69 @@
+'''Cost of logging the same exception over and over, as a failing upstream does every cycle.
+
+    python3 -m benchmarks.exceptions [calls]
+
+Logs an exception raised a few frames deep with large locals, once with repeats deduplicated and
+once with exception_quiet below zero so every call renders the full trace the way it did before.
+Then times the structured trace of the JSON renderer with the locals caps and without them.
+Output goes to /dev/null.
+'''
+import os
+import reprlib
+import sys
+import time
+
+from bankid.warden import Warden
+
+
+def fetch(depth, payload):
+    if depth:
+        return fetch(depth - 1, payload)
+    page = list(payload.values())  # noqa: F841
+    raise ConnectionError('Cannot connect to host www.bankid.no:443')
+
+
+def timed(log, calls):
+    payload = {n: 'x' * 100 for n in range(2000)}
+    began = time.perf_counter()
+    for _ in range(calls):
+        try:
+            fetch(8, payload)
+        except ConnectionError:
+            log.exception('Unable to get data from bankid.no')
+    return (time.perf_counter() - began) / calls
+
+
+def main(calls='2000'):
+    os.environ['JSON'] = '1'
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    stdout = os.dup(1)
+    os.dup2(devnull, 1)
+    log = Warden()
+    log.show_locals, log.locals_max_string = True, 80
+
+    deduplicated = timed(log, int(calls))
+    log.exception_quiet = -1
+    every = timed(log, int(calls))
+
+    try:
+        fetch(8, {n: 'x' * 100 for n in range(2000)})
+    except ConnectionError as error:
+        began = time.perf_counter()
+        capped = len(str(log._get_traceback_dicts(error)))
+        capped_time = time.perf_counter() - began
+        log.locals_max_count = log.locals_max_frames = log.locals_max_total = sys.maxsize
+        log.reprs = reprlib.Repr()
+        log.reprs.maxstring = log.reprs.maxother = log.reprs.maxdict = log.reprs.maxlevel = sys.maxsize
+        began = time.perf_counter()
+        uncapped = len(str(log._get_traceback_dicts(error)))
+        uncapped_time = time.perf_counter() - began
+
+    os.dup2(stdout, 1)
+    print(f'log.exception, repeats counted:   {deduplicated * 1e6:8.1f} us per call')
+    print(f'log.exception, every trace:       {every * 1e6:8.1f} us per call')
+    print(f'structured trace with caps:       {capped_time * 1e3:8.2f} ms, {capped} characters')
+    print(f'structured trace without caps:    {uncapped_time * 1e3:8.2f} ms, {uncapped} characters')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,108 @@
+'''Database size and write rate of the interval history against one raw row per sample.
+
+    python3 -m benchmarks.intervals [path/to/status.db]
+
+Migrates a copy of status.db and compares the vacuumed file sizes. Then replays every recorded
+sample, once through the previous put() that inserted a raw row and upserted the hourly rollup,
+and once through Timeline.put(), each into an empty database, counting write transactions.
+'''
+import asyncio
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from bankid.db import Pool
+from bankid.stats import Timeline
+from bankid.warden import Warden
+
+
+def vacuumed(path):
+    conn = sqlite3.connect(path)
+    conn.execute('VACUUM;')
+    # In WAL mode the vacuumed pages only reach the file with a checkpoint.
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+    conn.close()
+    return os.path.getsize(path)
+
+
+async def legacy(pool, samples):
+    '''The previous Timeline.put, one raw row and one rollup upsert per sample.'''
+    pool.write_blocking(
+        'CREATE TABLE status (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, time TIMESTAMP, status CHAR, color CHAR);'
+    )
+    pool.write_blocking('CREATE INDEX status_time ON status (time);')
+    pool.write_blocking('CREATE TABLE hourly (hour INTEGER PRIMARY KEY, time INTEGER, status CHAR, color CHAR, rank INTEGER);')
+    writes = 0
+    for now, status, color in samples:
+
+        def write(conn, now=now, status=status, color=color):
+            conn.execute('INSERT INTO status (time, status, color) VALUES(?, ?, ?);', (now, status, color))
+            if color in Timeline.severity:
+                conn.execute(
+                    """
+                    INSERT INTO hourly (hour, time, status, color, rank) VALUES(?, ?, ?, ?, ?)
+                    ON CONFLICT(hour) DO UPDATE SET
+                        time = excluded.time, status = excluded.status, color = excluded.color, rank = excluded.rank
+                    WHERE excluded.rank < hourly.rank;
+                    """,
+                    (now - now % 3600, now, status, color, Timeline.severity.index(color)),
+                )
+
+        await pool.transaction(write)
+        writes += 1
+    return writes
+
+
+async def intervals(timeline, samples):
+    writes = 0
+    transaction = timeline.pool.transaction
+
+    async def counted(func):
+        nonlocal writes
+        writes += 1
+        return await transaction(func)
+
+    timeline.pool.transaction = counted
+    for now, status, color in samples:
+        await timeline.put(status, color, now=now)
+    await timeline.checkpoint()
+    return writes
+
+
+def main(source='status.db'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'status.db')
+        shutil.copy(source, path)
+        samples = sqlite3.connect(path).execute('SELECT time, status, color FROM status ORDER BY time, id;').fetchall()
+        raw_size = vacuumed(path)
+        timeline = Timeline(path)
+        count = timeline.pool.read_blocking('SELECT COUNT(*) FROM intervals;')[0][0]
+        hours = timeline.pool.read_blocking('SELECT COUNT(*) FROM hourly;')[0][0]
+        timeline.pool.close()
+        migrated_size = vacuumed(path)
+
+        days = (samples[-1][0] - samples[0][0]) / 86400
+        results = {}
+        for name in ('raw rows', 'intervals'):
+            replay = os.path.join(tmp, f'{name}.db')
+            began = time.perf_counter()
+            if name == 'raw rows':
+                writes = asyncio.run(legacy(Pool(replay), samples))
+            else:
+                writes = asyncio.run(intervals(Timeline(replay), samples))
+            results[name] = writes, time.perf_counter() - began, vacuumed(replay)
+
+    print(f'{len(samples)} samples over {days:.1f} days migrated to {count} intervals and {hours} hourly rows')
+    print(f'status.db vacuumed: {raw_size} -> {migrated_size} bytes')
+    for name, (writes, elapsed, size) in results.items():
+        print(f'{name:10} {writes:6} write transactions, {writes / days:7.1f}/day, replay {elapsed:5.2f} s, {size} bytes')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,287 @@
+'''Load test of the whole web server against the stub upstream, with results written as JSON.
+
+    python3 -m benchmarks.load [seconds] [concurrency] [client processes] [users] [samples] [results.json]
+    python3 -m benchmarks.load compare old.json new.json
+
+Seeds a copy of users.db with extra users and status.db with a raw status history of the given
+number of samples, one every 15 seconds up to now with an incident now and then, which Timeline
+migrates to intervals on startup. Webserver.run() then serves from its own process with the
+upstreams pointed at the stub, and retention set to keep the whole history so no pruning runs
+during the measurement.
+
+Each scenario hits one target for the given time from the client processes, concurrency requests
+in flight each: /{key}/bankid, /{key}/api, /health and /{key}/api with a random key. Latency is
+measured per request by the clients, event loop lag by a 5 ms sleep in the server process. The
+results go to results.json, by default load-<commit>.json, and compare prints two of them side by side.
+'''
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import secrets
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from benchmarks.stub import Upstream, workspace
+
+SCENARIOS = {
+    'bankid': '/abcd/bankid',
+    'api': '/abcd/api',
+    'health': '/health',
+    'unauthorized': '/{random}/api',
+}
+WARMUP = 1.0
+
+
+def seed_users(path, count):
+    conn = sqlite3.connect(path)
+    users = [(secrets.token_hex(20), f'user {n}', f'{n}@example.com', '', 'free_account', -1) for n in range(count)]
+    with conn:
+        conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?);', users)
+    conn.close()
+
+
+def seed_status(path, count, step=15):
+    '''Writes count raw samples into the old status table, mostly green with short incidents.'''
+    conn = sqlite3.connect(path)
+    conn.execute('DROP TABLE IF EXISTS status;')
+    conn.execute('CREATE TABLE status (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, time TIMESTAMP, status CHAR, color CHAR);')
+    rng = random.Random(1)
+    now = int(time.time())
+
+    def samples():
+        incident = 0
+        for n in range(count):
+            if incident == 0 and rng.random() < 0.0005:
+                incident = rng.randint(4, 240)
+                color, status = rng.choice([('orange', 'BankID: Redusert tilgjengelighet.'), ('red', 'BankID: Ute av drift.')])
+            if incident:
+                incident -= 1
+                yield now - (count - n) * step, status, color
+            else:
+                yield now - (count - n) * step, 'BankID: Alt virker.', 'green'
+
+    with conn:
+        conn.executemany('INSERT INTO status (time, status, color) VALUES (?, ?, ?);', samples())
+    conn.close()
+    return count * step / 86400
+
+
+def server(pipe):
+    '''Runs Webserver.run() and answers every message on the pipe with the loop lags measured since the last one.'''
+    from bankid.warden import Warden
+    from bankid.webserver import Webserver
+
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+
+    async def monitor(lags, interval=0.005):
+        while True:
+            began = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append((time.perf_counter() - began - interval) * 1000)
+
+    async def main():
+        web_server = Webserver()
+        web_server.bidi.url = os.environ['BENCH_STATUS_URL']
+        web_server.bidi.statuspage_url = os.environ['BENCH_STATUSPAGE_URL']
+        lags = []
+        tasks = [asyncio.create_task(web_server.run()), asyncio.create_task(monitor(lags))]
+        loop = asyncio.get_running_loop()
+        while await loop.run_in_executor(None, pipe.recv) is not None:
+            pipe.send(lags[:])
+            lags.clear()
+        for task in tasks:
+            task.cancel()
+
+    asyncio.run(main())
+
+
+def clients(url, seconds, concurrency, results):
+    '''Sends requests for seconds after a warm-up and puts the latencies in milliseconds and the error count.'''
+
+    async def client(session, began, deadline, latencies, errors):
+        while time.monotonic() < deadline:
+            target = url.format(random=secrets.token_hex(8))
+            sent = time.perf_counter()
+            try:
+                async with session.get(target) as r:
+                    await r.read()
+            except aiohttp.ClientError:
+                errors.append(target)
+                continue
+            if time.monotonic() >= began:
+                latencies.append((time.perf_counter() - sent) * 1000)
+
+    async def run():
+        latencies, errors = [], []
+        began = time.monotonic() + WARMUP
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+            await asyncio.gather(*(client(session, began, began + seconds, latencies, errors) for _ in range(concurrency)))
+        results.put((latencies, len(errors)))
+
+    asyncio.run(run())
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(len(values) * q))], 3)
+
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(values[-1], 3)}
+
+
+async def ready(base, code, timeout=120):
+    '''Waits until the server answers and has scraped the stub once.'''
+    began = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() - began < timeout:
+            try:
+                async with session.get(f'{base}/abcd/api') as r:
+                    if (await r.json())['bidi'].get('bidi', {}).get('status') == code:
+                        return time.monotonic() - began
+            except (aiohttp.ClientError, KeyError):
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError('The server did not come up')
+
+
+def scenario(base, path, seconds, concurrency, processes, pipe):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    load = [context.Process(target=clients, args=(base + path, seconds, concurrency, results)) for _ in range(processes)]
+    pipe.send('reset')
+    pipe.recv()
+    for process in load:
+        process.start()
+    latencies, errors = [], 0
+    for _ in load:
+        part, failed = results.get()
+        latencies.extend(part)
+        errors += failed
+    for process in load:
+        process.join()
+    pipe.send('lags')
+    lags = pipe.recv()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / seconds, 1),
+        'latency_ms': percentiles(latencies),
+        'loop_lag_ms': percentiles(lags),
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(seconds='10', concurrency='50', processes='1', users='10000', samples='2000000', output=None):
+    seconds, concurrency, processes = float(seconds), int(concurrency), int(processes)
+    upstream = Upstream().start_in_thread()
+    os.environ['BENCH_STATUS_URL'] = upstream.url
+    os.environ['BENCH_STATUSPAGE_URL'] = upstream.statuspage_url
+    revision = commit()
+    output = output or f'load-{revision or "unknown"}.json'
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    with workspace('users.db', 'templates'):
+        began = time.perf_counter()
+        seed_users('users.db', int(users))
+        days = seed_status('status.db', int(samples))
+        seeded = time.perf_counter() - began
+        with open('config.json', 'w', encoding='UTF-8') as config:
+            keep = int(days) + 2
+            json.dump(
+                {
+                    'webserver': {'host': '127.0.0.1', 'port': port},
+                    'refresh_time': 10,
+                    'retention': {'raw_days': keep, 'hourly_days': max(keep, 7)},
+                },
+                config,
+            )
+
+        context = multiprocessing.get_context('spawn')
+        pipe, child = context.Pipe()
+        process = context.Process(target=server, args=(child,))
+        try:
+            began = time.perf_counter()
+            process.start()
+            base = f'http://127.0.0.1:{port}'
+            startup = asyncio.run(ready(base, upstream.code))
+            intervals = sqlite3.connect('status.db').execute('SELECT COUNT(*) FROM intervals;').fetchone()[0]
+            results = {}
+            for name, path in SCENARIOS.items():
+                results[name] = scenario(base, path, seconds, concurrency, processes, pipe)
+                print(
+                    f'{name:13} {results[name]["throughput"]:8.0f} req/s'
+                    f'  p50 {results[name]["latency_ms"]["p50"]:7.2f}  p95 {results[name]["latency_ms"]["p95"]:7.2f}'
+                    f'  p99 {results[name]["latency_ms"]["p99"]:7.2f} ms'
+                    f'  loop lag p99 {results[name]["loop_lag_ms"]["p99"]:6.2f} ms  errors {results[name]["errors"]}'
+                )
+            pipe.send(None)
+        finally:
+            process.terminate()
+            process.join()
+
+    document = {
+        'commit': revision,
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'aiohttp': aiohttp.__version__,
+        'cpus': os.cpu_count(),
+        'parameters': {
+            'seconds': seconds,
+            'concurrency': concurrency,
+            'client_processes': processes,
+            'users': int(users),
+            'samples': int(samples),
+        },
+        'seed': {'seconds': round(seeded, 2), 'days': round(days, 1), 'intervals': intervals},
+        'startup_seconds': round(startup, 2),
+        'scenarios': results,
+    }
+    with open(output, 'w', encoding='UTF-8') as results_file:
+        json.dump(document, results_file, indent=2)
+    print(f'{int(samples)} samples over {days:.0f} days seeded in {seeded:.1f} s, {intervals} intervals')
+    print(f'first scraped response after {startup:.2f} s, results written to {output}')
+
+
+def compare(old, new):
+    '''Prints throughput and latency of two result files side by side.'''
+    with open(old, encoding='UTF-8') as a, open(new, encoding='UTF-8') as b:
+        before, after = json.load(a), json.load(b)
+    print(f'{"":13} {before["commit"] or old:>22} {after["commit"] or new:>22}')
+    for name in [name for name in before['scenarios'] if name in after['scenarios']]:
+        for label, field in (('req/s', 'throughput'), ('p50 ms', 'p50'), ('p99 ms', 'p99')):
+            pair = [
+                results['scenarios'][name][field] if field == 'throughput' else results['scenarios'][name]['latency_ms'][field]
+                for results in (before, after)
+            ]
+            change = f'{(pair[1] - pair[0]) / pair[0] * 100:+6.1f}%' if pair[0] else ''
+            print(f'{name:13} {label:8} {pair[0]:13.2f} {pair[1]:22.2f} {change}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['compare']:
+        compare(*sys.argv[2:4])
+    else:
+        run(*sys.argv[1:7])
@@ -0,0 +1,78 @@
+'''Request throughput and the cost of a log call with logging off, rendered inline and through the queue.
+
+    python3 -m benchmarks.log_pipeline [requests] [log calls]
+
+Every mode runs in its own process, since queue mode is chosen when Warden is first set up, with
+stdout pointed at /dev/null so the writes still happen. "off" replaces the log methods with no-ops,
+"inline" is the default synchronous rendering and "queue" is LOG_QUEUE=1. Requests go to
+/{key}/api through the aiohttp test client, once with the hot-path "Access granted" event
+aggregated by count() as it is now, and once logged with info() on every request as it was before.
+'''
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+from benchmarks.stub import workspace
+
+MODES = {'off': {}, 'inline': {}, 'queue': {'LOG_QUEUE': '1'}}
+
+
+def measure(mode, requests, calls, results):
+    os.environ.update(MODES[mode])
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import bankid.classes
+    from bankid.warden import Warden
+    from bankid.webserver import Webserver
+
+    log = Warden()
+    if mode == 'off':
+        log.info = log.debug = log.warn = log.count = lambda *args, **kwargs: None
+
+    began = time.perf_counter()
+    for n in range(calls):
+        log.info('Access granted to api', user='someone@example.com', n=n)
+    call = (time.perf_counter() - began) / calls
+    # The writer thread catches up before the requests are timed.
+    while Warden.events is not None and Warden.events.qsize():
+        time.sleep(0.01)
+
+    async def hammer(server):
+        rates = {}
+        async with TestClient(TestServer(server.application())) as client:
+            for variant in ('count', 'info'):
+                bankid.classes.log.count = log.count if variant == 'count' else log.info
+                for _ in range(100):
+                    await (await client.get('/abcd/api')).read()
+                began = time.perf_counter()
+                for _ in range(requests):
+                    await (await client.get('/abcd/api')).read()
+                rates[variant] = requests / (time.perf_counter() - began)
+        return rates
+
+    rates = asyncio.run(hammer(Webserver()))
+    results.put((mode, call, rates, log.dropped))
+
+
+def main(requests='3000', calls='20000'):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with workspace():
+        for mode in MODES:
+            process = context.Process(target=measure, args=(mode, int(requests), int(calls), results))
+            process.start()
+            mode, call, rates, dropped = results.get()
+            process.join()
+            print(
+                f'{mode:7} log.info {call * 1e6:6.2f} us   /api {rates["count"]:6.0f} req/s aggregated,'
+                f' {rates["info"]:6.0f} req/s logging every hit   dropped {dropped}'
+            )
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,69 @@
+'''How many long-polling /api requests one server process can hold, and how fast they are all released.
+
+    python3 -m benchmarks.long_poll [clients] [rounds]
+
+Uses the server process from benchmarks.stream_soak. Every client asks for /{key}/api?since=<version>
+&wait=60 and is parked on the status version. The parent then asks the server for a transition and
+measures how long it takes until every parked request has returned, and then parks them again.
+'''
+import asyncio
+import multiprocessing
+import statistics
+import sys
+import time
+
+import aiohttp
+
+from benchmarks.stream_soak import rss, server
+from benchmarks.stub import workspace
+
+
+async def poll(session, url, since, returned):
+    async with session.get(url, params={'since': since, 'wait': 60}, timeout=aiohttp.ClientTimeout(total=None)) as r:
+        document = await r.json()
+    returned.append((time.perf_counter(), document['version']))
+
+
+async def park(pid, pipe, port, clients, rounds):
+    url = f'http://127.0.0.1:{port}/abcd/api'
+    before = rss(pid)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        async with session.get(url) as r:
+            version = (await r.json())['version']
+
+        released, peak = [], 0
+        for n in range(rounds):
+            returned = []
+            tasks = [asyncio.create_task(poll(session, url, version, returned)) for _ in range(clients)]
+            await asyncio.sleep(2)
+            peak = max(peak, rss(pid))
+            assert not returned, 'Requests returned before the version moved'
+
+            began = time.perf_counter()
+            pipe.send(n)
+            await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+            await asyncio.gather(*tasks)
+            released.append((max(at for at, _ in returned) - began) * 1000)
+            version = returned[0][1]
+            assert all(seen == version for _, seen in returned)
+
+    print(f'{clients} parked requests, server RSS {before / 2**20:.1f} -> {peak / 2**20:.1f} MiB,'
+          f' {(peak - before) / clients / 1024:.1f} KiB per request')
+    print(f'every request released after: median {statistics.median(released):.1f} ms, max {max(released):.1f} ms')
+
+
+def main(clients='2000', rounds='5'):
+    with workspace():
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=server, args=(child, 15.0))
+        process.start()
+        try:
+            port = parent.recv()
+            asyncio.run(park(process.pid, parent, port, int(clients), int(rounds)))
+        finally:
+            parent.send(None)
+            process.join()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
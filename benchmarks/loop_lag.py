@@ -0,0 +1,127 @@
+'''Event-loop lag of the Webserver under concurrent embed traffic, with sqlite on the loop and off it.
+
+    python3 -m benchmarks.loop_lag [seconds] [clients] [pause between requests per client]
+
+Clients run in a separate process and hit /{key}/bankid, half of them with random keys so the key
+cache keeps missing. Meanwhile the server process writes a timeline sample every 50 ms and flushes
+stats every 500 ms. The "inline" run executes every query on the event loop with the default
+rollback journal, the way the service did before the Pool existed.
+'''
+import asyncio
+import multiprocessing
+import secrets
+import statistics
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+import bankid.db
+import bankid.stats
+from bankid.db import Pool
+from bankid.warden import Warden
+from bankid.webserver import Webserver
+from benchmarks.stub import workspace
+
+
+class InlinePool(Pool):
+    '''Runs every statement directly on the calling thread, blocking the loop.'''
+
+    pragmas = ('PRAGMA busy_timeout=5000;',)
+
+    async def read(self, sql, params=()):
+        return self._read(sql, params)
+
+    async def write(self, sql, params=(), many=False):
+        return self._write(sql, params, many)
+
+    async def transaction(self, func):
+        return self._transaction(func)
+
+    def read_blocking(self, sql, params=()):
+        return self._read(sql, params)
+
+    def write_blocking(self, sql, params=(), many=False):
+        return self._write(sql, params, many)
+
+
+def clients(url, key, seconds, concurrency, pause, results):
+    async def client(session, deadline, counts):
+        while time.monotonic() < deadline:
+            target = key if counts['sent'] % 2 else secrets.token_hex(8)
+            counts['sent'] += 1
+            async with session.get(url.format(key=target)) as r:
+                await r.read()
+            await asyncio.sleep(pause)
+
+    async def run():
+        counts = {'sent': 0}
+        deadline = time.monotonic() + seconds
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+            await asyncio.gather(*(client(session, deadline, counts) for _ in range(concurrency)))
+        results.put(counts['sent'])
+
+    asyncio.run(run())
+
+
+async def monitor(stop, lags, interval=0.005):
+    while not stop.is_set():
+        began = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - began - interval) * 1000)
+
+
+async def writes(server, stop):
+    n = 0
+    while not stop.is_set():
+        await server.bidi.timeline.put('BankID: Alt virker.', 'green')
+        await server.stat.authorized()
+        n += 1
+        if n % 10 == 0:
+            await server.stat.flush()
+        await asyncio.sleep(0.05)
+
+
+async def serve(server, seconds, concurrency, pause):
+    runner = web.AppRunner(server.application())
+    await runner.setup()
+    site = web.TCPSite(runner, host='127.0.0.1', port=0)
+    await site.start()
+    url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/{{key}}/bankid'
+
+    stop = asyncio.Event()
+    lags = []
+    tasks = [asyncio.create_task(monitor(stop, lags)), asyncio.create_task(writes(server, stop))]
+    results = multiprocessing.Queue()
+    load = multiprocessing.Process(target=clients, args=(url, 'abcd', seconds, concurrency, pause, results))
+    load.start()
+    sent = await asyncio.get_running_loop().run_in_executor(None, results.get)
+    load.join()
+    stop.set()
+    await asyncio.gather(*tasks)
+    await runner.cleanup()
+    return sent / seconds, lags
+
+
+def main(seconds='10', concurrency='50', pause='0.05'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+
+    for name, pool in (('inline', InlinePool), ('pool', Pool)):
+        with workspace():
+            bankid.db.Pool = bankid.stats.Pool = pool
+            try:
+                server = Webserver()
+                rate, lags = asyncio.run(serve(server, int(seconds), int(concurrency), float(pause)))
+            finally:
+                bankid.db.Pool = bankid.stats.Pool = Pool
+        lags.sort()
+        print(
+            f'{name:7} {rate:7.0f} req/s   loop lag p50 {statistics.median(lags):6.2f} ms'
+            f'  p99 {lags[int(len(lags) * 0.99)]:6.2f} ms  max {lags[-1]:6.2f} ms'
+        )
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
@@ -0,0 +1,63 @@
+'''Cost of the /metrics instrumentation: an observation, a rendering, and the middleware per request.
+
+    python3 -m benchmarks.metrics [observations] [requests]
+
+Observes into a labelled histogram, renders the registry once a Webserver has registered its
+gauges, and times /health through the aiohttp test client with and without the middleware.
+'''
+import asyncio
+import sys
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from bankid import metrics
+from bankid.warden import Warden
+from bankid.webserver import Webserver
+from benchmarks.stub import workspace
+
+
+async def hammer(build, count):
+    app = build()
+    async with TestClient(TestServer(app)) as client:
+        for _ in range(100):
+            await (await client.get('/health')).read()
+        began = time.perf_counter()
+        for _ in range(count):
+            await (await client.get('/health')).read()
+        return (time.perf_counter() - began) / count
+
+
+def main(observations='1000000', requests='5000'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+
+    histogram = metrics.Histogram('bench_seconds', 'Benchmark observations.', ('route',))
+    began = time.perf_counter()
+    for n in range(int(observations)):
+        histogram.observe(n % 1000 / 1e5, '/{key}/api')
+    observe = (time.perf_counter() - began) / int(observations)
+    del metrics.registry['bench_seconds']
+
+    with workspace():
+        server = Webserver()
+
+        def plain():
+            app = web.Application()
+            app.add_routes([web.get('/health', server.healthcheck)])
+            return app
+
+        bare = asyncio.run(hammer(plain, int(requests)))
+        measured = asyncio.run(hammer(server.application, int(requests)))
+        began = time.perf_counter()
+        body = metrics.render()
+        render = time.perf_counter() - began
+
+    print(f'observe: {observe * 1e9:.0f} ns')
+    print(f'render: {render * 1000:.2f} ms, {len(body)} bytes, {len(metrics.registry)} metrics')
+    print(f'/health: {bare * 1e6:.0f} us without the middleware, {measured * 1e6:.0f} us with it')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,99 @@
+'''Checks StatusParser against the old double BeautifulSoup parse and times both.
+
+    python3 -m benchmarks.parser [recorded pages ...]
+
+Recorded pages are saved copies of https://www.bankid.no/status. Without any, pages are built with
+benchmarks.stub for every status code plus a few awkward cases. Needs beautifulsoup4 installed.
+'''
+import asyncio
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+from bankid.bankid import BankID
+from benchmarks.stub import SEVERITY, page, workspace
+
+
+def legacy(bidi, data):
+    '''parsedata and get_extra as they were before the single pass parser.'''
+    code = 9
+    soup = BeautifulSoup(data, 'html.parser')
+    for _data in soup.find_all('div', {'class': 'm-statuspage'}):
+        _data = str(_data).replace('\n', '')
+        matches = [number for number in bidi.code if bidi.code[number]['field'] in _data]
+        if matches:
+            code = matches[0]
+            break
+    if code in [1, 9]:
+        return code, None
+    ret = None
+    soup = BeautifulSoup(data, 'html.parser')
+    for x in soup.find_all('div', {'class': 'm-statuspage-description'}):
+        ret = x.find_next('p').get_text().replace('\n', '').replace('\r', '').strip()
+    return code, ret if ret is not None else '\nKunne ikke innhente detaljert informasjon om bankidfeil.'
+
+
+def pages():
+    built = {f'code {code}': page(code, nonce='x' * 32).encode() for code in (1, 2, 3, 4, 5)}
+    built['entities'] = page(3, 'Telenor &amp; Telia-kunder\r\n  har   problemer &lt;nå&gt;').encode()
+    built['no statuspage'] = page(1).replace('m-statuspage', 'm-something').encode()
+    built['no description'] = page(4).replace('m-statuspage-description', 'm-other').encode()
+    built['two dots'] = page(3).replace('<h2>', '<span class="color-dot none"></span><h2>').encode()
+    built['description first'] = description_first(3)
+    return built
+
+
+def description_first(code):
+    '''The description paragraph ahead of the status dot, with no m-statuspage class after the dot.'''
+    built = page(3, nonce='x' * 32)
+    header = built[built.index('<div class="m-statuspage-header">'):built.index('</div>') + len('</div>')]
+    description = built[built.index('<div class="m-statuspage-description">'):]
+    description = description[:description.index('</div>') + len('</div>')]
+    dot = f'<span class="color-dot {SEVERITY[code]}"></span>'
+    return built.replace(header, '').replace(description, description + dot).encode()
+
+
+def sections(bidi):
+    '''Every change of the dot must change the section that from_bankid hashes, whatever the page shape.'''
+    for name, build in {'stub': lambda code: page(code, nonce='x' * 32).encode(), 'description first': description_first}.items():
+        cut = {code: bidi.section(build(code)) for code in (1, 2, 3, 4, 5)}
+        assert len(set(cut.values())) == len(cut), f'{name}: a status change leaves the section unchanged'
+        assert bidi.section(build(3)) == bidi.section(build(3).replace(b'x' * 32, b'y' * 32)), f'{name}: nonce in section'
+
+
+async def timed(func, data, rounds):
+    began = time.perf_counter()
+    for _ in range(rounds):
+        await func(data)
+    return (time.perf_counter() - began) / rounds * 1000
+
+
+async def run(corpus, rounds):
+    bidi = BankID(None)
+    bidi.log.info = lambda *args, **kwargs: None
+
+    async def old(data):
+        return legacy(bidi, data)
+
+    sections(bidi)
+    for name, data in corpus.items():
+        new = await bidi.parsedata(data)
+        assert new == await old(data), f'{name}: {new!r} != {await old(data)!r}'
+        old_ms = await timed(old, data, rounds)
+        new_ms = await timed(bidi.parsedata, data, rounds)
+        print(f'{name:20} code {new[0]}  beautifulsoup {old_ms:7.3f} ms  single pass {new_ms:7.3f} ms  ({len(data)} bytes)')
+
+
+def main(*recorded, rounds=200):
+    corpus = pages()
+    for path in recorded:
+        with open(path, 'rb') as recording:
+            corpus[path] = recording.read()
+
+    with workspace('status.db'):
+        asyncio.run(run(corpus, rounds))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
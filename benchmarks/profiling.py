@@ -0,0 +1,57 @@
+'''Cost of the profiling mode: per request with it off, with stage timings only, and with every request profiled.
+
+    python3 -m benchmarks.profiling [requests]
+
+Times /{key}/api and /{key}/bankid through the aiohttp test client in one process, switching the
+profiler settings between runs. The slow threshold is set out of reach so nothing is logged.
+'''
+import asyncio
+import sys
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from bankid import profiling
+from bankid.warden import Warden
+from bankid.webserver import Webserver
+from benchmarks.stub import workspace
+
+MODES = {'off': (False, 0.0), 'stages': (True, 0.0), 'profiled': (True, 1.0)}
+
+
+async def measure(server, count):
+    results = {}
+    async with TestClient(TestServer(server.application())) as client:
+        for path in ('/abcd/api', '/abcd/bankid'):
+            for mode, (enabled, sample) in MODES.items():
+                profiling.profiler.enabled, profiling.profiler.sample = enabled, sample
+                for _ in range(100):
+                    await (await client.get(path)).read()
+                began = time.perf_counter()
+                for _ in range(count):
+                    await (await client.get(path)).read()
+                results[path, mode] = (time.perf_counter() - began) / count
+    return results
+
+
+def main(requests='3000'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+    profiling.profiler.slow = float('inf')
+
+    began = time.perf_counter()
+    for _ in range(1000000):
+        with profiling.stage('sqlite'):
+            pass
+    stage = (time.perf_counter() - began) / 1000000
+
+    with workspace():
+        results = asyncio.run(measure(Webserver(), int(requests)))
+
+    print(f'stage() with nothing measured: {stage * 1e9:.0f} ns')
+    for path in ('/abcd/api', '/abcd/bankid'):
+        print(f'{path:14}' + ''.join(f'  {mode} {results[path, mode] * 1e6:5.0f} us' for mode in MODES))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
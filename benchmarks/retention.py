@@ -0,0 +1,73 @@
+'''Applies the retention policy to a copy of status.db and reports how long each write transaction held the lock.
+
+    python3 -m benchmarks.retention [path/to/status.db] [raw days] [hourly days] [batch]
+
+The policy is applied as of the newest sample in the database, after Timeline() has migrated it to
+intervals. A single DELETE of the raw rows older than the cutoff, the way a one-off cleanup of the
+old status table would be written, is timed on an unmigrated copy for comparison.
+'''
+import asyncio
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from bankid.retention import Retention
+from bankid.stats import Timeline
+from bankid.warden import Warden
+
+
+def timed(transaction, durations):
+    async def wrapper(func):
+        def run(conn):
+            began = time.perf_counter()
+            try:
+                return func(conn)
+            finally:
+                durations.append((time.perf_counter() - began) * 1000)
+
+        return await transaction(run)
+
+    return wrapper
+
+
+def main(source='status.db', raw_days='7', hourly_days='30', batch='500'):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'status.db')
+        shutil.copy(source, path)
+        shutil.copy(path, os.path.join(tmp, 'single.db'))
+        timeline = Timeline(path)
+        newest = timeline.pool.read_blocking('SELECT MAX(until) FROM intervals;')[0][0]
+
+        retention = Retention(timeline)
+        retention.raw_days, retention.hourly_days, retention.batch = int(raw_days), int(hourly_days), int(batch)
+        before = os.path.getsize(path)
+        durations = []
+        timeline.pool.transaction = timed(timeline.pool.transaction, durations)
+        began = time.perf_counter()
+        pruned = asyncio.run(retention.run(newest))
+        elapsed = time.perf_counter() - began
+        timeline.pool.write_blocking('PRAGMA wal_checkpoint(TRUNCATE);')
+        after = os.path.getsize(path)
+
+        conn = sqlite3.connect(os.path.join(tmp, 'single.db'))
+        cutoff = newest - newest % 3600 - int(raw_days) * 86400
+        single = time.perf_counter()
+        with conn:
+            conn.execute('DELETE FROM status WHERE time < ?;', (cutoff,))
+        single = (time.perf_counter() - single) * 1000
+
+    print(f'pruned {pruned} in {elapsed:.2f} s, {len(durations)} transactions')
+    print(f'lock held per transaction: median {statistics.median(durations):.2f} ms, max {max(durations):.2f} ms')
+    print(f'single DELETE of the raw rows: {single:.2f} ms')
+    print(f'status.db {before} -> {after} bytes')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:5])
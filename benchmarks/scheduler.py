@@ -0,0 +1,109 @@
+'''Drives the Scheduler with a fake clock over simulated days with incidents.
+
+    python3 -m benchmarks.scheduler [days] [seed]
+
+Reports fetches per hour and how long it took to notice each incident starting and ending, for
+the fixed 60 second loop the service used to run and for the adaptive schedule.
+'''
+import asyncio
+import random
+import statistics
+import sys
+
+from bankid.classes import Status
+from bankid.scheduler import Scheduler
+
+
+class Stop(Exception):
+    pass
+
+
+class FakeClock:
+    '''Time only moves when the scheduler sleeps or an update runs. Sleeping past end stops the run.'''
+
+    def __init__(self, end):
+        self.now = 0.0
+        self.end = end
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+        if self.now >= self.end:
+            raise Stop()
+        await asyncio.sleep(0)
+
+
+class FakeBankID:
+    '''Stands in for BankID, update() reads the simulated upstream status at the current fake time.'''
+
+    def __init__(self, clock, incidents, duration=1.5):
+        self.clock = clock
+        self.incidents = incidents
+        self.duration = duration
+        self.refresh = 60
+        self.status = Status(1)
+        self.fetches = 0
+        self.seen = {}
+
+    def upstream(self, now):
+        for number, (start, stop, code) in enumerate(self.incidents):
+            if start <= now < stop:
+                return number, code
+        return None, 1
+
+    def notify(self):
+        pass
+
+    async def update(self):
+        self.fetches += 1
+        number, code = self.upstream(self.clock.now)
+        self.clock.now += self.duration
+        self.status = Status(code)
+        if number is not None:
+            self.seen.setdefault(number, self.clock.now)
+        for previous, (_, stop, _) in enumerate(self.incidents):
+            if previous in self.seen and number != previous and stop <= self.clock.now:
+                self.seen.setdefault(('ended', previous), self.clock.now)
+
+
+def incidents(days, seed):
+    rng = random.Random(seed)
+    found = []
+    start = rng.uniform(3600, 6 * 3600)
+    while start < days * 86400 - 7200:
+        length = rng.uniform(300, 3600)
+        found.append((start, start + length, rng.choice((2, 3, 3, 4))))
+        start += length + rng.uniform(3 * 3600, 12 * 3600)
+    return found
+
+
+async def simulate(days, seed, adaptive):
+    clock = FakeClock(days * 86400)
+    bidi = FakeBankID(clock, incidents(days, seed))
+    scheduler = Scheduler(bidi, clock=clock, sleep=clock.sleep, rng=random.Random(seed).random)
+    if not adaptive:
+        scheduler.degraded_factor = scheduler.calm_factor = 1
+        scheduler.jitter = 0
+    try:
+        await scheduler.run()
+    except Stop:
+        pass
+    onset = [bidi.seen[n] - start for n, (start, _, _) in enumerate(bidi.incidents) if n in bidi.seen]
+    recovery = [bidi.seen[('ended', n)] - stop for n, (_, stop, _) in enumerate(bidi.incidents) if ('ended', n) in bidi.seen]
+    return bidi.fetches / (days * 24), onset, recovery, len(bidi.incidents)
+
+
+def main(days='7', seed='1'):
+    for name, adaptive in (('fixed 60s', False), ('adaptive', True)):
+        per_hour, onset, recovery, count = asyncio.run(simulate(int(days), int(seed), adaptive))
+        print(
+            f'{name:10} {per_hour:5.1f} fetches/hour, {len(onset)}/{count} incidents seen,'
+            f' onset mean {statistics.mean(onset):5.1f}s max {max(onset):5.1f}s,'
+            f' recovery mean {statistics.mean(recovery):5.1f}s max {max(recovery):5.1f}s'
+        )
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,52 @@
+'''Steady-state cost of the bankid.no scrape path when the status does not change.
+
+    python3 -m benchmarks.scrape_cycle [cycles]
+
+Compares always parsing, the content hash short-circuit and a conditional GET against the local stub.
+CPU time is measured on the scraping thread only, the stub runs on its own thread.
+'''
+import asyncio
+import sys
+import time
+
+from bankid.bankid import BankID
+from bankid.db import Database
+from bankid.stats import Stats
+from benchmarks.stub import Upstream, workspace
+
+
+async def cycles(bidi, upstream, count, always_parse):
+    sent = upstream.sent
+    began = time.thread_time()
+    for _ in range(count):
+        if always_parse:
+            bidi.forget()
+        await bidi.apply('bankid', await bidi.from_bankid())
+    cpu = (time.thread_time() - began) / count * 1000
+    return cpu, (upstream.sent - sent) / count
+
+
+async def run(count):
+    for name, conditional, always_parse in (
+        ('always parse', False, True),
+        ('content hash', False, False),
+        ('conditional GET', True, False),
+    ):
+        upstream = Upstream(code=3, conditional=conditional).start_in_thread()
+        bidi = BankID(Stats(Database()))
+        bidi.url = upstream.url
+        # Warm up the connection pool and the stored digest/validators.
+        await bidi.apply('bankid', await bidi.from_bankid())
+        bidi.parses = {'full': 0, 'skipped': 0}
+        cpu, sent = await cycles(bidi, upstream, count, always_parse)
+        print(f'{name:16} {cpu:7.3f} ms CPU/cycle, {sent:8.0f} bytes/cycle, parses {bidi.parses}')
+        await bidi.close()
+
+
+def main(count='200'):
+    with workspace('status.db'):
+        asyncio.run(run(int(count)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,80 @@
+'''Measures /health latency on the serving loop while BankID scrapes a slow upstream.
+
+    python3 -m benchmarks.slow_upstream [upstream delay in seconds]
+
+The blocking baseline fetches with urllib the same way requests.get used to, inside the coroutine.
+'''
+import asyncio
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+from aiohttp import web
+
+from bankid.bankid import BankID
+from bankid.db import Database
+from bankid.stats import Stats
+from benchmarks.stub import Upstream, workspace
+
+
+def probe(url, stop, samples):
+    '''Polls /health from its own thread, like an outside client would.'''
+    while not stop.is_set():
+        began = time.perf_counter()
+        urllib.request.urlopen(url).read()
+        samples.append((time.perf_counter() - began) * 1000)
+        time.sleep(0.02)
+
+
+async def measure(update, health_url):
+    stop = threading.Event()
+    samples = []
+    prober = threading.Thread(target=probe, args=(health_url, stop, samples))
+    prober.start()
+    await asyncio.sleep(0.2)
+    began = time.perf_counter()
+    await update()
+    elapsed = time.perf_counter() - began
+    await asyncio.sleep(0.1)
+    stop.set()
+    await asyncio.get_running_loop().run_in_executor(None, prober.join)
+    return elapsed, samples
+
+
+async def run(delay):
+    upstream = Upstream(delay=delay).start_in_thread()
+    bidi = BankID(Stats(Database()))
+    bidi.url, bidi.statuspage_url = upstream.url, upstream.statuspage_url
+
+    app = web.Application()
+    app.add_routes([web.get('/health', lambda _: web.json_response({'running': True}))])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host='127.0.0.1', port=0)
+    await site.start()
+    health_url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/health'
+
+    async def blocking_update():
+        urllib.request.urlopen(upstream.url).read()
+        urllib.request.urlopen(upstream.statuspage_url).read()
+
+    for name, update in (('blocking fetch', blocking_update), ('pooled aiohttp', bidi.update)):
+        elapsed, samples = await measure(update, health_url)
+        print(
+            f'{name:15} update {elapsed:6.2f} s, /health p50 {statistics.median(samples):8.2f} ms,'
+            f' max {max(samples):8.2f} ms over {len(samples)} probes'
+        )
+
+    await bidi.close()
+    await runner.cleanup()
+
+
+def main(delay='1.0'):
+    with workspace('status.db'):
+        asyncio.run(run(float(delay)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
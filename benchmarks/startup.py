@@ -0,0 +1,104 @@
+'''Cold start: import time, and time from interpreter start to the first /health and /{key}/bankid answers.
+
+    python3 -m benchmarks.startup [runs]
+
+Each run starts a new interpreter that imports bankid.webserver and runs Webserver.run() against
+the stub upstream in a copy of the working directory. The child reports how long the import took,
+and the parent polls /health and then /{key}/bankid from the moment it started the child. The
+medians over the runs are printed. This module only imports the standard library at the top, so
+the child's import time is that of the server alone.
+'''
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+
+def serve():
+    '''The child: reports the import time on stderr, then serves.'''
+    began = time.perf_counter()
+    from bankid.webserver import Webserver
+
+    imported = time.perf_counter() - began
+    modules = sorted(name for name in ('jinja2', 'multiprocessing', 'pstats') if name in sys.modules)
+    print(json.dumps({'import': imported, 'modules': modules}), file=sys.stderr, flush=True)
+
+    from bankid.warden import Warden
+
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+    web_server = Webserver()
+    web_server.bidi.url = os.environ['BENCH_STATUS_URL']
+    web_server.bidi.statuspage_url = os.environ['BENCH_STATUSPAGE_URL']
+    asyncio.run(web_server.run())
+
+
+async def first(url, started, timeout=60):
+    '''Seconds from started until url answers 200, and how long that answer took.'''
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() - started < timeout:
+            try:
+                sent = time.perf_counter()
+                async with session.get(url) as r:
+                    await r.read()
+                    if r.status == 200:
+                        return time.perf_counter() - started, time.perf_counter() - sent
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.005)
+    raise TimeoutError(url)
+
+
+def run(port):
+    started = time.perf_counter()
+    child = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.startup', 'serve'],
+        cwd=os.getcwd(),
+        env={**os.environ, 'PYTHONPATH': os.environ['BENCH_ROOT']},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        health, _ = asyncio.run(first(f'http://127.0.0.1:{port}/health', started))
+        embed, render = asyncio.run(first(f'http://127.0.0.1:{port}/abcd/bankid', started))
+        report = json.loads(child.stderr.readline())
+    finally:
+        child.terminate()
+        child.wait()
+    return report, health, embed, render
+
+
+def main(runs='5'):
+    from benchmarks.stub import Upstream, workspace
+
+    upstream = Upstream().start_in_thread()
+    os.environ['BENCH_STATUS_URL'] = upstream.url
+    os.environ['BENCH_STATUSPAGE_URL'] = upstream.statuspage_url
+    os.environ['BENCH_ROOT'] = os.getcwd()
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    results = []
+    with workspace(config={'webserver': {'host': '127.0.0.1', 'port': port}, 'refresh_time': 60}):
+        for _ in range(int(runs)):
+            results.append(run(port))
+
+    print(f'import bankid.webserver   {statistics.median(r[0]["import"] for r in results) * 1000:6.0f} ms')
+    print(f'first /health             {statistics.median(r[1] for r in results) * 1000:6.0f} ms after start')
+    print(f'first /{{key}}/bankid       {statistics.median(r[2] for r in results) * 1000:6.0f} ms after start')
+    print(f'  that request took       {statistics.median(r[3] for r in results) * 1000:6.1f} ms')
+    print(f'imported before serving:  {", ".join(results[0][0]["modules"]) or "none of jinja2, multiprocessing, pstats"}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve()
+    else:
+        main(*sys.argv[1:2])
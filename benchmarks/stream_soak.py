@@ -0,0 +1,121 @@
+'''Soak test for /{key}/stream with thousands of idle local clients.
+
+    python3 -m benchmarks.stream_soak [clients] [transitions] [heartbeat seconds]
+
+The server runs in its own process so its resident memory can be read from /proc before and after
+the clients connect. Every client reads the initial event, then waits. The parent then asks the
+server for a number of status transitions and measures how long publish() takes and how long it
+takes for the event to reach every client. The clients stay connected over a couple of heartbeats.
+'''
+import asyncio
+import multiprocessing
+import statistics
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from bankid.warden import Warden
+from benchmarks.stub import workspace
+
+
+def rss(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def server(pipe, heartbeat):
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+    from bankid.webserver import Webserver
+
+    async def run():
+        web_server = Webserver()
+        web_server.bidi.broadcast.heartbeat = heartbeat
+        runner = web.AppRunner(web_server.application())
+        await runner.setup()
+        site = web.TCPSite(runner, host='127.0.0.1', port=0, backlog=4096)
+        await site.start()
+        pipe.send(site._server.sockets[0].getsockname()[1])
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None, pipe.recv)
+            if command is None:
+                break
+            # A new description every time, so every call is a transition.
+            began = time.perf_counter()
+            await web_server.bidi.updatestatus(2, f'Transition {command}')
+            pipe.send((time.perf_counter() - began, len(web_server.bidi.broadcast.subscribers)))
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+async def reader(session, url, received, connected):
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=None)) as r:
+        async for line in r.content:
+            if line.startswith(b'event: status'):
+                if r not in connected:
+                    connected.add(r)
+                else:
+                    received.append(time.perf_counter())
+            elif line.startswith(b': heartbeat'):
+                received.heartbeats += 1
+
+
+class Received(list):
+    heartbeats = 0
+
+
+async def soak(pid, pipe, port, clients, transitions, heartbeat):
+    url = f'http://127.0.0.1:{port}/abcd/stream'
+    before = rss(pid)
+    connected, received = set(), Received()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        tasks = [asyncio.create_task(reader(session, url, received, connected)) for _ in range(clients)]
+        while len(connected) < clients:
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(1)
+        after = rss(pid)
+        print(f'{clients} clients connected, server RSS {before / 2**20:.1f} -> {after / 2**20:.1f} MiB,'
+              f' {(after - before) / clients / 1024:.1f} KiB per connection')
+
+        publish, fanout = [], []
+        for n in range(transitions):
+            received.clear()
+            began = time.perf_counter()
+            pipe.send(n)
+            elapsed, subscribers = await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+            publish.append(elapsed * 1000)
+            while len(received) < clients:
+                await asyncio.sleep(0.01)
+            fanout.append((max(received) - began) * 1000)
+        print(f'updatestatus with {subscribers} subscribers: median {statistics.median(publish):.2f} ms')
+        print(f'event reached every client: median {statistics.median(fanout):.1f} ms, max {max(fanout):.1f} ms')
+
+        await asyncio.sleep(heartbeat * 2.5)
+        print(f'{received.heartbeats} heartbeats received, {received.heartbeats / clients:.1f} per client')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main(clients='2000', transitions='10', heartbeat='2'):
+    with workspace():
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=server, args=(child, float(heartbeat)))
+        process.start()
+        try:
+            port = parent.recv()
+            asyncio.run(soak(process.pid, parent, port, int(clients), int(transitions), float(heartbeat)))
+        finally:
+            parent.send(None)
+            process.join()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
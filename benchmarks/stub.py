@@ -0,0 +1,129 @@
+'''Local stand-in for bankid.no and bankid-services.statuspage.io, and the scratch directory benchmarks run in.'''
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+from aiohttp import web
+
+SEVERITY = {1: 'none', 2: 'minor', 3: 'major', 4: 'critical', 5: 'maintenance'}
+# What a server needs in its working directory.
+SERVER = ('status.db', 'users.db', 'templates')
+EXTRA = 'BankID på mobil for Telenor-kunder er ikke tilgjengelig for øyeblikket.'
+
+
+def page(code: int = 1, extra: str = EXTRA, nonce: str = '') -> str:
+    '''A page shaped like https://www.bankid.no/status for the given status code.
+
+    nonce stands in for the per-request tokens the real page carries outside the status section.
+    '''
+    description = ''
+    if code != 1:
+        description = f'''
+            <div class="m-statuspage-description">
+                <h3>Driftsmelding</h3>
+                <p>
+                    {extra}
+                </p>
+            </div>'''
+    return f'''<!DOCTYPE html>
+<html lang="no">
+<head><title>Status | BankID</title></head>
+<body>
+    <header><nav><a href="/">BankID</a><a href="/privat">Privat</a><a href="/bedrift">Bedrift</a></nav></header>
+    <main>
+        <div class="m-statuspage">
+            <div class="m-statuspage-header">
+                <span class="color-dot {SEVERITY[code]}"></span>
+                <h2>Status for BankID</h2>
+            </div>{description}
+        </div>
+        {'<section><p>Innhold som ikke har noe med status å gjøre.</p></section>' * 40}
+    </main>
+    <script>window.csrf = "{nonce}";</script>
+</body>
+</html>'''
+
+
+class Upstream:
+    '''Serves /status and /api on localhost. delay and code can be changed while it is running.
+
+    With conditional set, /status answers If-None-Match with 304 the way a cooperative upstream would.
+    '''
+
+    def __init__(self, delay: float = 0.0, code: int = 1, conditional: bool = False):
+        self.delay = delay
+        self.code = code
+        self.conditional = conditional
+        self.extra = EXTRA
+        self.hits = {'status': 0, 'api': 0}
+        self.sent = 0
+        self.runner: web.AppRunner = None
+        self.port: int = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/status'
+
+    @property
+    def statuspage_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/api'
+
+    async def status(self, request):
+        self.hits['status'] += 1
+        await asyncio.sleep(self.delay)
+        etag = '"' + hashlib.md5(f'{self.code}{self.extra}'.encode()).hexdigest() + '"'
+        if self.conditional and request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        body = page(self.code, self.extra, uuid.uuid4().hex).encode()
+        self.sent += len(body)
+        headers = {'ETag': etag} if self.conditional else {}
+        return web.Response(body=body, content_type='text/html', headers=headers)
+
+    async def api(self, request):  # noqa: W0613
+        self.hits['api'] += 1
+        await asyncio.sleep(self.delay)
+        return web.json_response({'page': {'id': 'stub', 'name': 'BankID'}, 'status': {'indicator': SEVERITY[self.code]}})
+
+    async def start(self) -> 'Upstream':
+        app = web.Application()
+        app.add_routes([web.get('/status', self.status), web.get('/api', self.api)])
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host='127.0.0.1', port=0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+    def start_in_thread(self) -> 'Upstream':
+        '''Runs the stub on its own event loop, so a blocked caller loop cannot stall it.'''
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+        return self
+
+
+@contextlib.contextmanager
+def workspace(*paths: str, config: dict = None):
+    '''Runs the block in a temporary directory holding copies of paths, SERVER by default, so the real
+    databases are never touched. With config, a config.json holding it is written there too.'''
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in paths or SERVER:
+            (shutil.copytree if os.path.isdir(path) else shutil.copy)(path, os.path.join(tmp, path))
+        if config is not None:
+            with open(os.path.join(tmp, 'config.json'), 'w', encoding='UTF-8') as out:
+                json.dump(config, out)
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
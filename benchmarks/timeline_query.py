@@ -0,0 +1,100 @@
+'''Compares the old per-hour Timeline.query against the hourly rollup and ring buffer on a copy of status.db.
+
+The legacy query runs on a copy that keeps the raw rows, Timeline() migrates its own copy to intervals.
+
+    python3 -m benchmarks.timeline_query [path/to/status.db]
+'''
+import asyncio
+import datetime
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from bankid.stats import Timeline
+
+
+def legacy_query(cursor, now):
+    '''The original 168 round-trip implementation, kept here for reference.'''
+    first = now - 604800
+    start = first
+    end = start + 3600
+    query = 'SELECT time, status, color FROM status WHERE time BETWEEN ? AND ?'
+    for _ in range(first, now, 3600):
+        results = cursor.execute(query, (start, end)).fetchall()
+        dict_results = {'red': [], 'orange': [], 'yellow': [], 'green': [], 'blue': [], 'black': []}
+        for x in reversed(results):
+            _time, status, color = x
+            dict_results[color] = status, _time
+        for k, v in dict_results.items():
+            if k in ('red', 'orange', 'blue', 'green', 'grey', 'black') and len(v) > 0:
+                yield {
+                    'time': datetime.datetime.fromtimestamp(v[1]).strftime('%Y-%m-%d %H:59:59'),
+                    'color': k,
+                    'status': v[0],
+                }
+                break
+        start += 3600
+        end += 3600
+
+
+def timed(func, rounds):
+    began = time.perf_counter()
+    for _ in range(rounds):
+        result = list(func())
+    return (time.perf_counter() - began) / rounds * 1000, result
+
+
+def main(source='status.db', rounds=20):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'status.db')
+        shutil.copy(source, path)
+        shutil.copy(source, os.path.join(tmp, 'legacy.db'))
+
+        raw = sqlite3.connect(os.path.join(tmp, 'legacy.db'))
+        oldest, newest, rows = raw.execute('SELECT MIN(time), MAX(time), COUNT(*) FROM status').fetchone()
+        # The middle of the recorded history has a fully populated week, the edges do not.
+        middle = (oldest + newest) // 2
+        legacy_ms, _ = timed(lambda: legacy_query(raw.cursor(), middle), rounds)
+        raw.execute('CREATE INDEX status_time ON status (time);')
+        indexed_ms, _ = timed(lambda: legacy_query(raw.cursor(), middle), rounds)
+
+        timeline = Timeline(path)
+        rollup_db = sqlite3.connect(path)
+        began = time.perf_counter()
+        hours = asyncio.run(timeline.backfill())
+        backfill_ms = (time.perf_counter() - began) * 1000
+        timeline.load(middle)
+        ring_ms, result = timed(lambda: timeline.query(middle), rounds)
+        rollup = 'SELECT hour, time, status, color FROM hourly WHERE hour BETWEEN ? AND ? ORDER BY hour;'
+        window = (middle - middle % 3600 - 167 * 3600, middle)
+        rollup_ms, _ = timed(lambda: rollup_db.execute(rollup, window).fetchall(), rounds)
+        assert [row['status'] for row in result] == [row[2] for row in rollup_db.execute(rollup, window)]
+
+        # Replaying the raw rows through put() must build the same rollup as the migration.
+        replayed = Timeline(os.path.join(tmp, 'replay.db'))
+        samples = raw.execute('SELECT time, status, color FROM status ORDER BY time, id;').fetchall()
+
+        async def replay_all():
+            for _time, status, color in samples:
+                await replayed.put(status, color, now=_time)
+
+        began = time.perf_counter()
+        asyncio.run(replay_all())
+        put_us = (time.perf_counter() - began) / rows * 1000000
+        everything = 'SELECT * FROM hourly ORDER BY hour;'
+        assert replayed.pool.read_blocking(everything) == rollup_db.execute(everything).fetchall(), 'put() and migrate() differ'
+
+    print(f'rows in status: {rows}, hours in rollup: {hours}')
+    print(f'legacy, no index:   {legacy_ms:8.2f} ms/query')
+    print(f'legacy, time index: {indexed_ms:8.2f} ms/query')
+    print(f'rollup query:       {rollup_ms:8.2f} ms/query')
+    print(f'ring buffer:        {ring_ms:8.2f} ms/query')
+    print(f'backfill:           {backfill_ms:8.2f} ms')
+    print(f'put with intervals: {put_us:8.2f} us/row')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
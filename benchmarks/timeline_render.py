@@ -0,0 +1,85 @@
+'''Renders bankid.html with the ring buffer timeline and with the sqlite rollup generator it replaced.
+
+    python3 -m benchmarks.timeline_render [path/to/status.db]
+'''
+import asyncio
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import jinja2
+
+from bankid.classes import Status
+from bankid.stats import Timeline
+
+
+class RollupTimeline:
+    '''The previous Timeline.query, reading the hourly rollup on every render.'''
+
+    def __init__(self, path, now):
+        self.cursor = sqlite3.connect(path).cursor()
+        self.now = now
+
+    def query(self):
+        current = self.now - self.now % 3600
+        query = 'SELECT time, status, color FROM hourly WHERE hour BETWEEN ? AND ? ORDER BY hour;'
+        for _time, status, color in self.cursor.execute(query, (current - 167 * 3600, current)).fetchall():
+            yield {'time': Timeline.e2t(None, _time), 'color': color, 'status': status}
+
+
+class PinnedTimeline:
+    '''Pins the ring buffer to a point in the recorded history, the template calls query() without arguments.'''
+
+    def __init__(self, timeline, now):
+        self.timeline = timeline
+        self.now = now
+
+    def query(self):
+        return self.timeline.query(self.now)
+
+
+def footprint(timeline):
+    '''Bytes held by the ring buffer, including the interned strings and hour labels.'''
+    parts = [timeline.hours, timeline.ranks, timeline.texts, timeline.labels, timeline.strings, timeline.string_ids]
+    parts += timeline.strings + timeline.labels
+    return sum(sys.getsizeof(part) for part in parts)
+
+
+def render(template, timeline, rounds):
+    data = {'data': Status().__dict__, 'timeline': timeline}
+    tracemalloc.start()
+    body = template.render(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    began = time.perf_counter()
+    for _ in range(rounds):
+        template.render(data)
+    return (time.perf_counter() - began) / rounds * 1000, peak, body
+
+
+def main(source='status.db', rounds=500):
+    template = jinja2.Environment(loader=jinja2.FileSystemLoader('templates')).get_template('bankid.html')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'status.db')
+        shutil.copy(source, path)
+        timeline = Timeline(path)
+        asyncio.run(timeline.backfill())
+        oldest, newest = timeline.pool.read_blocking('SELECT MIN(start), MAX(until) FROM intervals;')[0]
+        middle = (oldest + newest) // 2
+        timeline.load(middle)
+
+        rollup_ms, rollup_peak, rollup_body = render(template, RollupTimeline(path, middle), rounds)
+        ring_ms, ring_peak, ring_body = render(template, PinnedTimeline(timeline, middle), rounds)
+        assert rollup_body == ring_body, 'Ring buffer renders differently from the rollup'
+
+    print(f'ring buffer resident size: {footprint(timeline)} bytes')
+    print(f'sqlite rollup render:      {rollup_ms:8.3f} ms, peak {rollup_peak} bytes allocated')
+    print(f'ring buffer render:        {ring_ms:8.3f} ms, peak {ring_peak} bytes allocated')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,89 @@
+'''Time from process start to the first correct status, starting cold and starting from state.json.
+
+    python3 -m benchmarks.warm_start [upstream delay seconds]
+
+Runs Webserver.run() in a fresh process against the stub upstream, which answers after the given
+delay with an orange status. The parent polls /{key}/api and /{key}/bankid from the moment the
+process is started, and notes when the server first answered and when both first showed orange.
+The first run has no state file. It is stopped once the file has been written, and the second run
+starts from it.
+'''
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+import aiohttp
+
+from benchmarks.stub import Upstream, workspace
+
+
+def server():
+    from bankid.warden import Warden
+    from bankid.webserver import Webserver
+
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+    web_server = Webserver()
+    web_server.bidi.url = os.environ['BENCH_STATUS_URL']
+    web_server.bidi.statuspage_url = os.environ['BENCH_STATUSPAGE_URL']
+    asyncio.run(web_server.run())
+
+
+async def poll(base, started, timeout=120):
+    '''Seconds from started to the first answer, and to the first answers that both show the orange status.'''
+    answered = None
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() - started < timeout:
+            try:
+                async with session.get(f'{base}/abcd/api') as r:
+                    document = await r.json()
+                    answered = answered or time.perf_counter() - started
+                async with session.get(f'{base}/abcd/bankid') as r:
+                    page = await r.text()
+                if document['bidi'].get('bidi', {}).get('status') == 3 and 'orange' in page:
+                    return answered, time.perf_counter() - started, document['sources']
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.01)
+    raise TimeoutError('The server never showed the upstream status')
+
+
+def run(base):
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=server)
+    started = time.perf_counter()
+    process.start()
+    try:
+        answered, correct, sources = asyncio.run(poll(base, started))
+        began = time.perf_counter()
+        while not os.path.exists('state.json') and time.perf_counter() - began < 60:
+            time.sleep(0.05)
+    finally:
+        process.terminate()
+        process.join()
+    return answered, correct, sources
+
+
+def main(delay='3'):
+    upstream = Upstream(delay=float(delay), code=3).start_in_thread()
+    os.environ['BENCH_STATUS_URL'] = upstream.url
+    os.environ['BENCH_STATUSPAGE_URL'] = upstream.statuspage_url
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    with workspace(config={'webserver': {'host': '127.0.0.1', 'port': port}, 'refresh_time': 60}):
+        for name in ('cold', 'warm'):
+            answered, correct, sources = run(f'http://127.0.0.1:{port}')
+            stale = sorted(source for source, state in sources.items() if state.get('stale'))
+            print(
+                f'{name}: first answer after {answered:.2f} s, correct status after {correct:.2f} s'
+                f' (stale sources in that answer: {", ".join(stale) or "none"})'
+            )
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
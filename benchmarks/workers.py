@@ -0,0 +1,138 @@
+'''Multi-worker serving: throughput with 1 and N workers, and how long a scraper takeover takes.
+
+    python3 -m benchmarks.workers [workers] [seconds] [client processes]
+
+Runs bankid.cluster.serve against the stub upstream in a copy of the working directory. Client
+processes hit /{key}/api over keep-alive connections for the given time, first with one worker and
+then with the given number. With several workers the scraper is then killed with SIGKILL. The
+benchmark measures how long it takes until another worker holds the lease, and until every worker
+serves a status change made upstream after the kill.
+'''
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+import aiohttp
+
+from bankid.cluster import Lease, serve
+from benchmarks.stub import Upstream, workspace
+
+
+def worker():
+    from bankid.warden import Warden
+    from bankid.webserver import Webserver
+
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+    server = Webserver()
+    server.bidi.url = os.environ['BENCH_STATUS_URL']
+    server.bidi.statuspage_url = os.environ['BENCH_STATUSPAGE_URL']
+    asyncio.run(server.run(cluster=True))
+
+
+def supervise(workers):
+    from bankid.warden import Warden
+
+    log = Warden()
+    log.info = log.debug = lambda *args, **kwargs: None
+    serve(workers, target=worker)
+
+
+def hammer(url, seconds, results):
+    async def client(session, deadline, counts):
+        while time.monotonic() < deadline:
+            async with session.get(url) as r:
+                await r.read()
+            counts['sent'] += 1
+
+    async def run():
+        counts = {'sent': 0}
+        deadline = time.monotonic() + seconds
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=20)) as session:
+            await asyncio.gather(*(client(session, deadline, counts) for _ in range(20)))
+        results.put(counts['sent'])
+
+    asyncio.run(run())
+
+
+async def statuses(url, count):
+    '''The status code seen by count requests, each on a new connection so they spread over the workers.'''
+    seen = set()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(force_close=True)) as session:
+        for _ in range(count):
+            try:
+                async with session.get(url) as r:
+                    seen.add((await r.json())['bidi'].get('bidi', {}).get('status'))
+            except aiohttp.ClientConnectionError:
+                seen.add(None)
+    return seen
+
+
+def wait_until(condition, timeout=60):
+    began = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - began > timeout:
+            raise TimeoutError
+        time.sleep(0.01)
+    return time.perf_counter() - began
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def run(workers, seconds, clients, upstream, port, takeover):
+    context = multiprocessing.get_context('spawn')
+    supervisor = context.Process(target=supervise, args=(workers,))
+    supervisor.start()
+    url = f'http://127.0.0.1:{port}/abcd/api'
+    lease = Lease()
+    try:
+        wait_until(lambda: lease.holder() and asyncio.run(statuses(url, workers * 4)) == {upstream.code})
+        results = context.Queue()
+        load = [context.Process(target=hammer, args=(url, seconds, results)) for _ in range(clients)]
+        for process in load:
+            process.start()
+        sent = sum(results.get() for _ in load)
+        for process in load:
+            process.join()
+        print(f'{workers} worker(s): {sent / seconds:8.0f} req/s')
+
+        if takeover:
+            scraper = lease.holder()
+            os.kill(scraper, signal.SIGKILL)
+            killed = time.perf_counter()
+            upstream.code = 3 if upstream.code == 1 else 1
+            elected = wait_until(lambda: lease.holder() not in (0, scraper) and alive(lease.holder()))
+            print(f'new scraper after {elected * 1000:.0f} ms')
+            wait_until(lambda: asyncio.run(statuses(url, workers * 4)) == {upstream.code})
+            print(f'every worker serves the new status after {(time.perf_counter() - killed) * 1000:.0f} ms')
+    finally:
+        supervisor.terminate()
+        supervisor.join()
+
+
+def main(workers='4', seconds='10', clients='2'):
+    upstream = Upstream().start_in_thread()
+    os.environ['BENCH_STATUS_URL'] = upstream.url
+    os.environ['BENCH_STATUSPAGE_URL'] = upstream.statuspage_url
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    print(f'{os.cpu_count()} cpu(s)')
+    for count in (1, int(workers)):
+        with workspace(config={'webserver': {'host': '127.0.0.1', 'port': port}, 'refresh_time': 10, 'workers': count}):
+            run(count, int(seconds), int(clients), upstream, port, takeover=count > 1)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
@@ -1,6 +1,7 @@
 #!/usr/bin/python3.10
 import asyncio
 from bankid.webserver import Webserver
+import bankid.cluster
 import bankid.warden
 
 log = bankid.warden.Warden()
@@ -9,8 +10,13 @@ log.loglevel = bankid.warden.DEBUG
 
 if __name__ == '__main__':
     web = Webserver()
-    try:
-        asyncio.run(web.run())
-    except AttributeError:
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(web.run())
+    web.config.read(web)
+    if web.workers > 1:
+        # The schema and any migrations are done above, before the workers start.
+        bankid.cluster.serve(web.workers)
+    else:
+        try:
+            asyncio.run(web.run())
+        except AttributeError:
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(web.run())